@@ -1,11 +1,34 @@
+import os
+
+if os.getenv("SERVER") == "gevent":
+    # must patch before anything imports socket, ssl or threading
+    from gevent import monkey
+
+    monkey.patch_all()
+
 import flask
 import stb
-import os
+import metrics
 import json
+import gzip
+import hashlib
+import sys
 import subprocess
 import uuid
 import logging
+import logging.handlers
+import collections
+import copy
+import queue
+import sqlite3
+import tempfile
+import threading
+import atexit
+import signal
+import time
 import xml.etree.cElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import closing
 from flask import (
     Flask,
     render_template,
@@ -26,7 +49,11 @@ app.secret_key = secrets.token_urlsafe(32)
 logger = logging.getLogger("STB-Proxy")
 logger.setLevel(logging.INFO)
 logFormat = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
-fileHandler = logging.FileHandler("STB-Proxy.log")
+logFile = "STB-Proxy.log"
+logTailBytes = 64 * 1024
+fileHandler = logging.handlers.RotatingFileHandler(
+    logFile, maxBytes=5 * 1024 * 1024, backupCount=3
+)
 fileHandler.setFormatter(logFormat)
 logger.addHandler(fileHandler)
 consoleFormat = logging.Formatter("[%(levelname)s] %(message)s")
@@ -46,8 +73,22 @@ if os.getenv("CONFIG"):
 else:
     configFile = os.path.join(basePath, "config.json")
 
-occupied = {}
+epgFile = os.path.join(os.path.dirname(configFile), "epg.db")
+urlsFile = os.path.join(os.path.dirname(configFile), "urls.json")
+
+if os.getenv("SERVER"):
+    server = os.getenv("SERVER")
+else:
+    server = "waitress"
+
 config = {}
+configLock = threading.Lock()
+configWriteLock = threading.Lock()
+configTimer = None
+configFlushDelay = 2  # seconds of changes coalesced into one write
+configVersion = 0  # bumped whenever portals or settings change
+fallbackIndex = {}
+channelSettings = {}  # portal id -> enabled channel ids and custom channel settings
 
 d_ffmpegcmd = "ffmpeg -re -http_proxy <proxy> -timeout <timeout> -i <url> -map 0 -codec copy -f mpegts pipe:"
 
@@ -69,6 +110,18 @@ defaultSettings = {
     "hdhr name": "STB-Proxy",
     "hdhr id": str(uuid.uuid4().hex),
     "hdhr tuners": "1",
+    "channel cache ttl": "3600",
+    "portal timeout": "30",
+    "portal connect timeout": "5",
+    "portal read timeout": "15",
+    "portal pool size": "10",
+    "stream chunk size": "64",
+    "stream test method": "ffprobe",
+    "stream test cache": "60",
+    "background stream testing": "false",
+    "mac test threads": "8",
+    "mac test rate": "5",
+    "mac check interval": "900",
 }
 
 defaultPortal = {
@@ -86,6 +139,14 @@ defaultPortal = {
     "fallback channels": {},
 }
 
+channelFields = {
+    "custom channel names": "name",
+    "custom channel numbers": "number",
+    "custom genres": "genre",
+    "custom epg ids": "epg id",
+    "fallback channels": "fallback",
+}
+
 
 def loadConfig():
     try:
@@ -119,23 +180,121 @@ def loadConfig():
             if not value or type(default) != type(value):
                 value = default
             portalsOut[portal][setting] = value
+        portalsOut[portal]["enabled channels"] = list(
+            dict.fromkeys(portalsOut[portal]["enabled channels"])
+        )
 
     data["portals"] = portalsOut
 
-    with open(configFile, "w") as f:
-        json.dump(data, f, indent=4)
+    writeJson(configFile, json.dumps(data, indent=4))
 
     return data
 
 
+def writeJson(path, data):
+    # write to a temp file and rename it so the file is never left half written
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path) or None, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # keep the mode of the file being replaced, it may hold passwords
+        if os.path.exists(path):
+            os.chmod(temp, os.stat(path).st_mode & 0o777)
+        else:
+            os.chmod(temp, 0o644)
+        os.replace(temp, path)
+    except:
+        os.remove(temp)
+        raise
+
+
+def saveConfig():
+    # changes are kept in memory and written once the flush delay has passed
+    global configTimer
+    with configLock:
+        if configTimer is None:
+            configTimer = threading.Timer(configFlushDelay, flushConfig)
+            configTimer.daemon = True
+            configTimer.start()
+
+
+def flushConfig():
+    global configTimer
+    with configWriteLock:
+        with configLock:
+            if configTimer is not None:
+                configTimer.cancel()
+                configTimer = None
+            data = json.dumps(config, indent=4)
+        writeJson(configFile, data)
+
+
+def flushPendingConfig():
+    if configTimer is not None:
+        flushConfig()
+
+
+atexit.register(flushPendingConfig)
+
+
 def getPortals():
     return config["portals"]
 
 
-def savePortals(portals):
-    with open(configFile, "w") as f:
+def updatePortals(change):
+    # change edits a copy of the portals which is swapped in under configLock,
+    # so the portals dict that readers and flushConfig see never changes
+    global configVersion
+    with configLock:
+        portals = copy.deepcopy(config["portals"])
+        result = change(portals)
         config["portals"] = portals
-        json.dump(config, f, indent=4)
+        configVersion = configVersion + 1
+    indexChannels()
+    saveConfig()
+    return result
+
+
+def indexChannels():
+    # one record of custom settings per channel and a set of enabled ids, so
+    # building playlists does not search lists for every channel
+    settings = {}
+    fallbacks = {}  # channel name -> [(portal id, channel id)] marked as fallback
+    portals = getPortals()
+    for portal in portals:
+        channels = {}
+        for key, field in channelFields.items():
+            for channelId, value in portals[portal].get(key, {}).items():
+                channels.setdefault(channelId, {})[field] = value
+        settings[portal] = {
+            "enabled": set(portals[portal].get("enabled channels", [])),
+            "channels": channels,
+        }
+        for channelId, channelName in (
+            portals[portal].get("fallback channels", {}).items()
+        ):
+            fallbacks.setdefault(channelName, []).append((portal, channelId))
+    global channelSettings, fallbackIndex
+    channelSettings = settings
+    fallbackIndex = fallbacks
+
+
+def getChannelSettings(portalId):
+    return channelSettings.get(portalId, {"enabled": set(), "channels": {}})
+
+
+def loadUrls():
+    try:
+        with open(urlsFile) as f:
+            stb.resolvedUrls.update(json.load(f))
+    except:
+        pass
+
+
+def saveUrls():
+    writeJson(urlsFile, json.dumps(stb.resolvedUrls, indent=4))
 
 
 def getSettings():
@@ -143,9 +302,29 @@ def getSettings():
 
 
 def saveSettings(settings):
-    with open(configFile, "w") as f:
+    global configVersion
+    with configLock:
         config["settings"] = settings
-        json.dump(config, f, indent=4)
+        configVersion = configVersion + 1
+    saveConfig()
+    configurePortalClients()
+
+
+def configurePortalClients():
+    # a zero, negative or broken value would make every portal call fail
+    settings = getSettings()
+
+    def number(setting, kind, minimum):
+        try:
+            return max(kind(settings[setting]), minimum)
+        except ValueError:
+            return kind(defaultSettings[setting])
+
+    stb.configure(
+        number("portal pool size", int, 1),
+        number("portal connect timeout", float, 1),
+        number("portal read timeout", float, 1),
+    )
 
 
 def authorise(f):
@@ -174,13 +353,922 @@ def authorise(f):
 
 
 def moveMac(portalId, mac):
+    # swaps in new dicts so threads iterating the old ones are not disturbed
+    with configLock:
+        portals = dict(getPortals())
+        if portalId not in portals or mac not in portals[portalId]["macs"]:
+            return
+        portal = dict(portals[portalId])
+        macs = portal["macs"]
+        moved = {m: expiry for m, expiry in macs.items() if m != mac}
+        moved[mac] = macs[mac]
+        portal["macs"] = moved
+        portals[portalId] = portal
+        config["portals"] = portals
+    metrics.inc("stb_mac_rotations_total", portal=portalId)
+    saveConfig()
+
+
+# Channel catalogue cache #
+
+catalogue = {}
+catalogueLocks = {}
+catalogueGenerations = {}
+catalogueLock = threading.Lock()
+catalogueExecutor = ThreadPoolExecutor(max_workers=16)
+
+
+def getCatalogueLock(portalId):
+    with catalogueLock:
+        return catalogueLocks.setdefault(portalId, threading.Lock())
+
+
+def fetchCatalogue(portalId):
+    portal = getPortals().get(portalId)
+    if not portal:
+        return None
+    url = portal["url"]
+    macs = list(portal["macs"].keys())
+    proxy = portal["proxy"]
+
+    for mac in macs:
+        # refreshes run in the background, so they are not a tune phase
+        with metrics.timer("stb_catalogue_refresh_seconds", portal=portalId):
+            allChannels = stb.sessionCall(stb.getAllChannels, url, mac, proxy=proxy)
+        if allChannels:
+            genres = stb.sessionCall(stb.getGenreNames, url, mac, proxy=proxy)
+            return {
+                "channels": allChannels,
+                "index": {str(c["id"]): c for c in allChannels},
+                "genres": genres or {},
+                "updated": time.time(),
+            }
+
+
+def refreshCatalogue(portalId):
+    # caller must hold the portal's catalogue lock
+    generation = catalogueGenerations.get(portalId, 0)
+    data = fetchCatalogue(portalId)
+    if data and catalogueGenerations.get(portalId, 0) == generation:
+        catalogue[portalId] = data
+        logger.info("Channel cache refreshed for Portal({})".format(portalId))
+        catalogueExecutor.submit(refreshEpg, portalId)
+    elif not data:
+        logger.error("Error refreshing channel cache for Portal({})".format(portalId))
+    return catalogue.get(portalId)
+
+
+def refreshCatalogueAsync(portalId):
+    lock = getCatalogueLock(portalId)
+    if not lock.acquire(blocking=False):
+        return  # a refresh is already running
+
+    def run():
+        try:
+            refreshCatalogue(portalId)
+        finally:
+            lock.release()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def getCatalogue(portalId):
+    entry = catalogue.get(portalId)
+    if entry is None:
+        with getCatalogueLock(portalId):
+            entry = catalogue.get(portalId)
+            if entry is None:
+                entry = refreshCatalogue(portalId)
+        metrics.inc("stb_cache_requests_total", cache="catalogue", result="miss")
+        return entry
+
+    if time.time() - entry["updated"] > int(getSettings()["channel cache ttl"]):
+        refreshCatalogueAsync(portalId)  # serve stale while revalidating
+        metrics.inc("stb_cache_requests_total", cache="catalogue", result="stale")
+    else:
+        metrics.inc("stb_cache_requests_total", cache="catalogue", result="hit")
+    return entry
+
+
+def fanOut(func, portalIds):
+    # Runs func for each portal concurrently, skipping portals that miss the
+    # deadline. Late portals keep running in the background.
     portals = getPortals()
-    macs = portals[portalId]["macs"]
-    x = macs[mac]
-    del macs[mac]
-    macs[mac] = x
-    portals[portalId]["macs"] = macs
-    savePortals(portals)
+    futures = {
+        portalId: catalogueExecutor.submit(func, portalId) for portalId in portalIds
+    }
+    wait(futures.values(), timeout=int(getSettings()["portal timeout"]))
+
+    results = {}
+    for portalId, future in futures.items():
+        if future.done():
+            results[portalId] = future.result()
+        else:
+            logger.warning(
+                "Portal({}) did not respond in time, skipping".format(
+                    portals[portalId]["name"]
+                )
+            )
+    return results
+
+
+def getCatalogues(portalIds):
+    return fanOut(getCatalogue, portalIds)
+
+
+def getChannel(portalId, channelId):
+    data = getCatalogue(portalId)
+    if data:
+        return data["index"].get(channelId)
+
+
+def invalidateCatalogue(portalId):
+    with catalogueLock:
+        catalogueGenerations[portalId] = catalogueGenerations.get(portalId, 0) + 1
+        catalogue.pop(portalId, None)
+    epgUpdated.pop(portalId, None)
+
+
+def catalogueRefresher():
+    while True:
+        try:
+            ttl = int(getSettings()["channel cache ttl"])
+            portals = getPortals()
+            for portalId in list(portals):
+                if portals[portalId]["enabled"] != "true":
+                    continue
+                entry = catalogue.get(portalId)
+                if entry is None or time.time() - entry["updated"] > ttl:
+                    refreshCatalogueAsync(portalId)
+        except:
+            logger.exception("Channel cache refresher error")
+        time.sleep(60)
+
+
+# EPG store #
+
+epgUpdated = {}  # portal id -> time the EPG was last stored
+epgLocks = {}
+
+
+def initEpg():
+    with closing(sqlite3.connect(epgFile)) as db, db:
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS programmes (portal TEXT, channel TEXT, "
+            "start INTEGER, stop INTEGER, title TEXT, descr TEXT, "
+            "PRIMARY KEY (portal, channel, start))"
+        )
+        stored = db.execute(
+            "SELECT DISTINCT portal FROM programmes WHERE stop > ?",
+            (int(time.time()),),
+        ).fetchall()
+    # guides kept from the last run are served until the next refresh replaces them
+    for (portalId,) in stored:
+        epgUpdated[portalId] = os.path.getmtime(epgFile)
+
+
+def getEpgLock(portalId):
+    with catalogueLock:
+        return epgLocks.setdefault(portalId, threading.Lock())
+
+
+def ensureEpg(portalId):
+    refreshEpg(portalId, onlyIfMissing=True)
+
+
+def refreshEpg(portalId, onlyIfMissing=False):
+    with getEpgLock(portalId):
+        if not onlyIfMissing or portalId not in epgUpdated:
+            storeEpg(portalId)
+
+
+def storeEpg(portalId):
+    portal = getPortals().get(portalId)
+    if not portal:
+        return
+    url = portal["url"]
+    proxy = portal["proxy"]
+
+    epg = None
+    for mac in list(portal["macs"].keys()):
+        epg = stb.sessionCall(stb.getEpg, url, mac, 24, proxy=proxy)
+        if epg:
+            break
+    if not epg:
+        logger.error("Error refreshing EPG for Portal({})".format(portalId))
+        return
+
+    rows = []
+    windows = {}  # channel id -> first start time in this update
+    for channelId, programmes in epg.items():
+        for p in programmes or []:
+            try:
+                start = int(p.get("start_timestamp"))
+                stop = int(p.get("stop_timestamp"))
+            except:
+                continue
+            channelId = str(channelId)
+            rows.append(
+                (portalId, channelId, start, stop, p.get("name"), p.get("descr"))
+            )
+            windows[channelId] = min(start, windows.get(channelId, start))
+
+    with closing(sqlite3.connect(epgFile, timeout=30)) as db, db:
+        # the new data replaces whatever was stored for the period it covers
+        db.executemany(
+            "DELETE FROM programmes WHERE portal = ? AND channel = ? AND stop > ?",
+            [(portalId, channelId, start) for channelId, start in windows.items()],
+        )
+        db.executemany(
+            "INSERT OR REPLACE INTO programmes VALUES (?, ?, ?, ?, ?, ?)", rows
+        )
+        db.execute(
+            "DELETE FROM programmes WHERE portal = ? AND stop < ?",
+            (portalId, int(time.time()) - 3600),
+        )
+    epgUpdated[portalId] = time.time()
+    logger.info("EPG refreshed for Portal({})".format(portalId))
+
+
+def removeEpg(portalId):
+    epgUpdated.pop(portalId, None)
+    with closing(sqlite3.connect(epgFile, timeout=30)) as db, db:
+        db.execute("DELETE FROM programmes WHERE portal = ?", (portalId,))
+
+
+# Dashboard events #
+
+
+class EventFeed:
+    # Ring buffer of dashboard events that every open dashboard follows
+
+    def __init__(self, size=1000):
+        self.events = collections.deque(maxlen=size)
+        self.seq = 0  # number of events published so far
+        self.condition = threading.Condition()
+
+    def publish(self, kind, data=None):
+        with self.condition:
+            self.events.append((kind, data))
+            self.seq = self.seq + 1
+            self.condition.notify_all()
+
+    def follow(self, timeout=15):
+        # yields lists of events published after this call, or an empty list
+        # after timeout seconds. The position is taken now, not on first next()
+        with self.condition:
+            position = self.seq
+        return self.batches(position, timeout)
+
+    def batches(self, position, timeout):
+        while True:
+            with self.condition:
+                if position >= self.seq:
+                    self.condition.wait(timeout)
+                oldest = self.seq - len(self.events)
+                position = max(position, oldest)
+                batch = list(self.events)[position - oldest :]
+                position = self.seq
+            yield batch
+
+
+class FeedHandler(logging.Handler):
+    def emit(self, record):
+        try:
+            feed.publish("log", self.format(record))
+        except:
+            self.handleError(record)
+
+
+feed = EventFeed()
+feedHandler = FeedHandler()
+feedHandler.setFormatter(logFormat)
+logger.addHandler(feedHandler)
+
+
+def readLogTail(offset=None):
+    # returns the log from offset (or its last logTailBytes) and the new offset
+    with open(logFile, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        if offset is None or offset > size or size - offset > logTailBytes:
+            start = max(size - logTailBytes, 0)  # first read, rotated or far behind
+        else:
+            start = offset
+        f.seek(start)
+        data = f.read(size - start)
+    if start != offset and start > 0:
+        data = data.partition(b"\n")[2]  # drop the partial first line
+    return data.decode(errors="replace"), size
+
+
+# MAC occupancy #
+
+
+class MacSlots:
+    # Counts streams per (portal, MAC) so a slot is checked and taken in one step
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}  # portal id -> {mac: streams using it}
+        self.streams = {}  # handle -> (portal id, dashboard entry)
+        self.probes = {}  # handle -> (portal id, mac) of background stream tests
+
+    def acquire(self, portalId, mac, limit, entry):
+        # returns a handle for release(), or None if the MAC is at its limit
+        with self.lock:
+            counts = self.counts.setdefault(portalId, {})
+            count = counts.get(mac, 0)
+            if limit and count >= limit:
+                return None
+            counts[mac] = count + 1
+            handle = uuid.uuid4().hex
+            entry = dict(entry)
+            entry["mac"] = mac
+            entry["start time"] = datetime.now(timezone.utc).timestamp()
+            self.streams[handle] = (portalId, entry)
+        logger.info("Occupied Portal({}):MAC({})".format(portalId, mac))
+        feed.publish("streams")
+        return handle
+
+    def acquireProbe(self, portalId, macs, limit):
+        # a quiet slot for a background probe, only taken if the portal keeps
+        # another free slot for a tune. Returns (handle, mac) or None
+        with self.lock:
+            counts = self.counts.setdefault(portalId, {})
+            free = [mac for mac in macs if not limit or counts.get(mac, 0) < limit]
+            if not free:
+                return None
+            if limit and sum(limit - counts.get(mac, 0) for mac in free) < 2:
+                return None
+            mac = free[0]
+            counts[mac] = counts.get(mac, 0) + 1
+            handle = uuid.uuid4().hex
+            self.probes[handle] = (portalId, mac)
+            return handle, mac
+
+    def release(self, handle):
+        with self.lock:
+            stream = self.streams.pop(handle, None)
+            probe = self.probes.pop(handle, None)
+            if stream:
+                portalId, mac = stream[0], stream[1]["mac"]
+            elif probe:
+                portalId, mac = probe
+            else:
+                return
+            counts = self.counts[portalId]
+            counts[mac] = counts[mac] - 1
+            if counts[mac] == 0:
+                del counts[mac]
+        if probe:
+            return  # probes are not shown on the dashboard
+        logger.info("Unoccupied Portal({}):MAC({})".format(portalId, mac))
+        feed.publish("streams")
+
+    def setClient(self, handle, client):
+        with self.lock:
+            if handle not in self.streams:
+                return
+            self.streams[handle][1]["client"] = client
+        feed.publish("streams")
+
+    def activeCounts(self):
+        # (portal id, mac) -> streams using it
+        with self.lock:
+            return {
+                (portalId, mac): count
+                for portalId, counts in self.counts.items()
+                for mac, count in counts.items()
+            }
+
+    def busyMacs(self, portalId):
+        with self.lock:
+            return set(self.counts.get(portalId, {}))
+
+    def snapshot(self):
+        # portal id -> list of stream entries, as shown on the dashboard
+        with self.lock:
+            occupied = {}
+            for portalId, entry in self.streams.values():
+                occupied.setdefault(portalId, []).append(dict(entry))
+            return occupied
+
+
+slots = MacSlots()
+
+
+# MAC testing #
+
+macJobs = {}
+macJobsLock = threading.Lock()
+macTestTimes = {}  # portal url -> earliest time the next test may start
+
+
+def testMac(url, mac, proxy):
+    token = stb.getToken(url, mac, proxy)
+    if token:
+        stb.getProfile(url, mac, token, proxy)
+        return stb.getExpires(url, mac, token, proxy)
+
+
+def startMacJob(name, url, proxy, macs, onFinish):
+    # Tests MACs concurrently off the request, then hands the working ones
+    # ({mac: expiry}) to onFinish which saves them in one go and returns
+    # (success, message).
+    job = {
+        "id": uuid.uuid4().hex,
+        "portal name": name,
+        "total": len(macs),
+        "done": 0,
+        "ok": 0,
+        "failed": [],
+        "finished": False,
+        "finished time": None,
+        "message": "",
+        "success": False,
+    }
+    threads = max(int(getSettings()["mac test threads"]), 1)
+    rate = float(getSettings()["mac test rate"])
+
+    def test(mac):
+        if rate > 0:
+            with macJobsLock:
+                delay = macTestTimes.get(url, 0) - time.time()
+                macTestTimes[url] = (
+                    max(macTestTimes.get(url, 0), time.time()) + 1 / rate
+                )
+            if delay > 0:
+                time.sleep(delay)
+
+        try:
+            expiry = testMac(url, mac, proxy)
+        except:
+            expiry = None
+
+        with macJobsLock:
+            job["done"] = job["done"] + 1
+            if expiry:
+                job["ok"] = job["ok"] + 1
+            else:
+                job["failed"].append(mac)
+        if expiry:
+            logger.info("Successfully tested MAC({}) for Portal({})".format(mac, name))
+        else:
+            logger.error("Error testing MAC({}) for Portal({})".format(mac, name))
+        return mac, expiry
+
+    def run():
+        try:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                results = executor.map(test, macs)
+                tested = {mac: expiry for mac, expiry in results if expiry}
+            job["success"], job["message"] = onFinish(tested)
+        except:
+            logger.exception("Error testing MACs for Portal({})".format(name))
+            job["message"] = "Error testing MACs for Portal({})".format(name)
+        finally:
+            job["finished time"] = time.time()
+            job["finished"] = True
+
+    with macJobsLock:
+        macJobs[job["id"]] = job
+        for old in [j for j in macJobs.values() if j["finished"]][:-20]:
+            del macJobs[old["id"]]  # only keep recent finished jobs
+    threading.Thread(target=run, daemon=True).start()
+    return job["id"]
+
+
+macHealth = {}  # (portal id, mac) -> latest health check results
+
+
+def recordMacHealth(portalId, mac, ok, latency=None, expiry=None):
+    health = macHealth.setdefault(
+        (portalId, mac),
+        {"latency": None, "expiry": None, "last success": None, "failures": 0},
+    )
+    health["last check"] = time.time()
+    if ok:
+        health["failures"] = 0
+        health["last success"] = time.time()
+        if latency is not None:
+            health["latency"] = latency
+        if expiry:
+            health["expiry"] = expiry
+    else:
+        health["failures"] = health["failures"] + 1
+
+
+def sortMacs(portalId, macs):
+    # healthy MACs by handshake latency, then unchecked, then failing ones
+    def score(mac):
+        health = macHealth.get((portalId, mac))
+        if not health:
+            return (0, float("inf"))
+        return (health["failures"], health["latency"] or float("inf"))
+
+    return sorted(macs, key=score)
+
+
+def checkMac(portalId, url, mac, proxy):
+    start = time.time()
+    token = stb.getSession(url, mac, proxy, force=True)
+    latency = round((time.time() - start) * 1000)
+    expiry = stb.getExpires(url, mac, token, proxy) if token else None
+    recordMacHealth(portalId, mac, bool(token), latency, expiry)
+    if not token:
+        logger.warning(
+            "Health check failed for Portal({}):MAC({})".format(portalId, mac)
+        )
+    return expiry
+
+
+def macHealthChecker():
+    # re-handshakes idle MACs off the request path and refreshes their expiry
+    while True:
+        interval = int(getSettings()["mac check interval"])
+        time.sleep(interval if interval > 0 else 60)
+        if interval <= 0:
+            continue
+        try:
+            portals = getPortals()
+            checks = {}
+            with ThreadPoolExecutor(
+                max_workers=max(int(getSettings()["mac test threads"]), 1)
+            ) as executor:
+                for portalId in list(portals):
+                    portal = portals[portalId]
+                    if portal["enabled"] != "true":
+                        continue
+                    busyMacs = slots.busyMacs(portalId)
+                    for mac in list(portal["macs"]):
+                        if mac not in busyMacs:
+                            checks[(portalId, mac)] = executor.submit(
+                                checkMac, portalId, portal["url"], mac, portal["proxy"]
+                            )
+
+            expiries = {key: future.result() for key, future in checks.items()}
+
+            def change(portals):
+                # applied to the current portals, which may have been edited since
+                for (portalId, mac), expiry in expiries.items():
+                    macs = portals.get(portalId, {}).get("macs", {})
+                    if expiry and mac in macs:
+                        macs[mac] = expiry
+
+            if any(
+                expiry and portals[portalId]["macs"].get(mac) != expiry
+                for (portalId, mac), expiry in expiries.items()
+            ):
+                updatePortals(change)
+        except:
+            logger.exception("MAC health checker error")
+
+
+# Stream testing #
+
+streamTests = {}  # (portal id, channel id) -> time of last passed test
+watched = {}  # (portal id, channel id) -> time last tuned
+
+
+def resolveLink(portalId, url, mac, cmd, proxy):
+    if "http://localhost/" in cmd:
+        with metrics.timer(
+            "stb_tune_phase_seconds", phase="create_link", portal=portalId
+        ):
+            return stb.sessionCall(stb.getLink, url, mac, cmd, proxy=proxy)
+    else:
+        return cmd.split(" ")[1]
+
+
+def testStream(link, proxy):
+    timeout = int(getSettings()["ffmpeg timeout"])
+
+    if getSettings()["stream test method"] == "http":
+        # live if the first bytes are TS packets or an HLS playlist
+        try:
+            response = stb.openStream(link, proxy, timeout)
+            try:
+                data = next(response.iter_content(188 * 4), b"")
+            finally:
+                response.close()
+            return data[:1] == b"\x47" or data.startswith(b"#EXTM3U")
+        except:
+            return False
+
+    ffprobecmd = ["ffprobe", "-timeout", str(timeout * int(1000000)), "-i", link]
+
+    if proxy:
+        ffprobecmd.insert(1, "-http_proxy")
+        ffprobecmd.insert(2, proxy)
+
+    with subprocess.Popen(
+        ffprobecmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    ) as ffprobe_sb:
+        ffprobe_sb.communicate()
+        if ffprobe_sb.returncode == 0:
+            return True
+        else:
+            return False
+
+
+def isStreamOk(portalId, channelId, link, proxy):
+    tested = streamTests.get((portalId, channelId))
+    if tested and time.time() - tested < int(getSettings()["stream test cache"]):
+        metrics.inc("stb_cache_requests_total", cache="stream test", result="hit")
+        return True
+    metrics.inc("stb_cache_requests_total", cache="stream test", result="miss")
+    with metrics.timer(
+        "stb_tune_phase_seconds", step="testStream", phase="probe", portal=portalId
+    ):
+        ok = testStream(link, proxy)
+    if ok:
+        streamTests[(portalId, channelId)] = time.time()
+        return True
+    streamTests.pop((portalId, channelId), None)
+    return False
+
+
+def streamTester():
+    # keeps recently watched channels tested so tunes can skip the probe
+    while True:
+        time.sleep(30)
+        try:
+            if getSettings()["background stream testing"] != "true":
+                continue
+            portals = getPortals()
+            for key, lastWatched in list(watched.items()):
+                portalId, channelId = key
+                if time.time() - lastWatched > 3600 or portalId not in portals:
+                    watched.pop(key, None)
+                    continue
+                tested = streamTests.get(key, 0)
+                if time.time() - tested < int(getSettings()["stream test cache"]) / 2:
+                    continue
+                c = getChannel(portalId, channelId)
+                if not c or getHub(portalId, channelId):
+                    continue
+                portal = portals[portalId]
+                limit = int(portal["streams per mac"])
+                # hold a slot for the probe so a tune cannot share the MAC
+                probe = slots.acquireProbe(portalId, list(portal["macs"]), limit)
+                if not probe:
+                    continue  # no spare slot, tunes come first
+                handle, mac = probe
+                try:
+                    url = portal["url"]
+                    proxy = portal["proxy"]
+                    link = resolveLink(portalId, url, mac, c["cmd"], proxy)
+                    if link:
+                        isStreamOk(portalId, channelId, link, proxy)
+                finally:
+                    slots.release(handle)
+        except:
+            logger.exception("Background stream tester error")
+
+
+# Tune traces #
+
+tunes = collections.deque(maxlen=50)  # traces of the most recent tunes
+
+
+def recordTune(trace):
+    trace["total ms"] = round((time.time() - trace["time"]) * 1000)
+    tunes.append(trace)
+    logger.info(
+        "Tune of Portal({}):Channel({}) {} in {}ms ({})".format(
+            trace["portal"],
+            trace["channel id"],
+            trace["result"],
+            trace["total ms"],
+            ", ".join("{} {}ms".format(step, ms) for step, ms in trace["steps"])
+            or "no portal calls",
+        )
+    )
+    feed.publish("tunes")
+
+
+def recordFirstByte(trace):
+    # from the request arriving to the first byte leaving the proxy
+    trace["first byte ms"] = round((time.time() - trace["time"]) * 1000)
+    feed.publish("tunes")
+
+
+# Stream hubs #
+
+hubs = {}
+hubsLock = threading.Lock()
+hubBufferChunks = 64
+
+
+def getChunkSize():
+    # whole 188 byte TS packets so viewers can join a hub mid-stream
+    size = int(getSettings()["stream chunk size"]) * 1024
+    return max(size // 188, 1) * 188
+
+
+def packetChunks(readinto, chunkSize):
+    # whole TS packets read into one reused buffer, a partial packet is carried
+    # over to the next read instead of concatenating bytes
+    buffer = bytearray(chunkSize)
+    view = memoryview(buffer)
+    filled = 0
+    while True:
+        count = readinto(view[filled:])
+        if not count:
+            break
+        filled = filled + count
+        size = filled - filled % 188
+        if size:
+            yield bytes(view[:size])
+            view[: filled - size] = view[size:filled]
+            filled = filled - size
+    if filled:
+        yield bytes(view[:filled])
+
+
+class StreamHub:
+    # One upstream (ffmpeg or relay) per (portal, channel) broadcast to every viewer
+
+    def __init__(
+        self,
+        portalId,
+        channelId,
+        ffmpegcmd,
+        link,
+        proxy,
+        url,
+        macPortalId,
+        mac,
+        portalName,
+        handle,
+    ):
+        self.portalId = portalId
+        self.channelId = channelId
+        self.ffmpegcmd = ffmpegcmd  # None relays the link without ffmpeg
+        self.link = link
+        self.proxy = proxy
+        self.url = url
+        self.macPortalId = macPortalId  # differs from portalId for fallbacks
+        self.mac = mac
+        self.portalName = portalName
+        self.handle = handle  # MAC slot, released when the upstream closes
+        self.trace = None  # trace of the tune that started the hub
+        self.chunkSize = getChunkSize()
+        self.chunks = collections.deque(maxlen=hubBufferChunks)
+        self.seq = 0  # number of chunks read so far
+        self.clients = []
+        self.process = None
+        self.response = None
+        self.started = False
+        self.stopped = False
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def start(self):
+        self.started = True
+        self.startTime = time.time()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        try:
+            if self.ffmpegcmd:
+                error = self.runFfmpeg()
+            else:
+                error = self.runRelay()
+            if error and not self.stopped:
+                logger.info(
+                    "{}. Moving MAC({}) for Portal({})".format(
+                        error, self.mac, self.portalName
+                    )
+                )
+                stb.invalidateSession(self.url, self.mac)
+                recordMacHealth(self.macPortalId, self.mac, False)
+                moveMac(self.macPortalId, self.mac)
+        except:
+            pass
+        finally:
+            self.close()
+
+    def runFfmpeg(self):
+        with subprocess.Popen(
+            self.ffmpegcmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        ) as self.process:
+            # publish whatever ffmpeg has written, up to chunkSize
+            for chunk in packetChunks(self.process.stdout.readinto1, self.chunkSize):
+                self.publish(chunk)
+            returncode = self.process.wait()
+            metrics.inc("stb_ffmpeg_exits_total", code=returncode)
+            if returncode != 0:
+                return "Ffmpeg closed with error({})".format(str(returncode))
+
+    def runRelay(self):
+        try:
+            self.response = stb.openStream(
+                self.link, self.proxy, int(getSettings()["ffmpeg timeout"])
+            )
+            raw = self.response.raw
+            read = getattr(raw, "read1", None) or raw.read  # read1 needs urllib3 2
+
+            def readinto(view):
+                data = read(len(view), decode_content=True)
+                view[: len(data)] = data
+                return len(data)
+
+            for chunk in packetChunks(readinto, self.chunkSize):
+                self.publish(chunk)
+        except Exception as e:
+            return "Relay closed with error({})".format(type(e).__name__)
+        finally:
+            if self.response is not None:
+                self.response.close()
+
+    def publish(self, chunk):
+        if self.seq == 0:
+            if self.trace:
+                recordFirstByte(self.trace)
+            metrics.observe(
+                "stb_tune_phase_seconds",
+                time.time() - self.startTime,
+                phase="first_byte",
+                portal=self.macPortalId,
+            )
+        metrics.inc(
+            "stb_relayed_bytes_total", len(chunk), portal=self.macPortalId, mac=self.mac
+        )
+        with self.condition:
+            self.chunks.append(chunk)
+            self.seq = self.seq + 1
+            self.condition.notify_all()
+
+    def close(self):
+        with hubsLock:
+            if hubs.get((self.portalId, self.channelId)) is self:
+                del hubs[(self.portalId, self.channelId)]
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        slots.release(self.handle)
+
+    def attach(self, ip):
+        with hubsLock:
+            if self.closed or self.stopped:
+                return False
+            self.clients.append(ip)
+            if not self.started:
+                self.start()
+            slots.setClient(self.handle, ", ".join(self.clients))
+            return True
+
+    def detach(self, ip):
+        with hubsLock:
+            self.clients.remove(ip)
+            if self.clients:
+                slots.setClient(self.handle, ", ".join(self.clients))
+                return
+            self.stopped = True  # last viewer left
+            if hubs.get((self.portalId, self.channelId)) is self:
+                del hubs[(self.portalId, self.channelId)]
+        if self.process:
+            self.process.kill()
+        if self.response is not None:
+            self.response.close()
+
+    def stream(self):
+        with self.condition:
+            position = max(self.seq - 1, 0)  # join at the live edge
+        while True:
+            with self.condition:
+                while position >= self.seq and not self.closed:
+                    self.condition.wait()
+                if position >= self.seq:
+                    break
+                oldest = self.seq - len(self.chunks)
+                position = max(position, oldest)  # skip ahead if too slow
+                chunk = self.chunks[position - oldest]
+            position = position + 1
+            yield chunk
+
+    def serve(self, ip):
+        # detach on close, which also runs if the body is never iterated
+        if not self.attach(ip):
+            return make_response("No streams available", 503)
+        response = Response(self.stream(), mimetype="application/octet-stream")
+        response.call_on_close(lambda: self.detach(ip))
+        return response
+
+
+def getHub(portalId, channelId):
+    hub = hubs.get((portalId, channelId))
+    if hub and not hub.closed and not hub.stopped:
+        return hub
 
 
 @app.route("/", methods=["GET"])
@@ -192,7 +1280,7 @@ def home():
 @app.route("/portals", methods=["GET"])
 @authorise
 def portals():
-    return render_template("portals.html", portals=getPortals())
+    return render_template("portals.html", portals=getPortals(), macHealth=macHealth)
 
 
 @app.route("/portal/add", methods=["POST"])
@@ -212,53 +1300,37 @@ def portalsAdd():
             logger.error("Error getting URL for Portal({})".format(name))
             flash("Error getting URL for Portal({})".format(name), "danger")
             return redirect("/portals", code=302)
+        saveUrls()
+
+    def finish(macsd):
+        if len(macsd) > 0:
+            portal = {
+                "enabled": enabled,
+                "name": name,
+                "url": url,
+                "macs": macsd,
+                "streams per mac": streamsPerMac,
+                "proxy": proxy,
+            }
+
+            for setting, default in defaultPortal.items():
+                if not portal.get(setting):
+                    portal[setting] = default
+
+            updatePortals(lambda portals: portals.update({id: portal}))
+            logger.info("Portal({}) added!".format(portal["name"]))
+            return True, "Portal({}) added!".format(name)
 
-    macsd = {}
-
-    for mac in macs:
-        token = stb.getToken(url, mac, proxy)
-        if token:
-            stb.getProfile(url, mac, token, proxy)
-            expiry = stb.getExpires(url, mac, token, proxy)
-            if expiry:
-                macsd[mac] = expiry
-                logger.info(
-                    "Successfully tested MAC({}) for Portal({})".format(mac, name)
-                )
-                flash(
-                    "Successfully tested MAC({}) for Portal({})".format(mac, name),
-                    "success",
+        else:
+            logger.error(
+                "None of the MACs tested OK for Portal({}). Adding not successfull".format(
+                    name
                 )
-                continue
-
-        logger.error("Error testing MAC({}) for Portal({})".format(mac, name))
-        flash("Error testing MAC({}) for Portal({})".format(mac, name), "danger")
-
-    if len(macsd) > 0:
-        portal = {
-            "enabled": enabled,
-            "name": name,
-            "url": url,
-            "macs": macsd,
-            "streams per mac": streamsPerMac,
-            "proxy": proxy,
-        }
-
-        for setting, default in defaultPortal.items():
-            if not portal.get(setting):
-                portal[setting] = default
-
-        portals = getPortals()
-        portals[id] = portal
-        savePortals(portals)
-        logger.info("Portal({}) added!".format(portal["name"]))
-
-    else:
-        logger.error(
-            "None of the MACs tested OK for Portal({}). Adding not successfull".format(
-                name
             )
-        )
+            return False, "None of the MACs tested OK for Portal({})".format(name)
+
+    startMacJob(name, url, proxy, macs, finish)
+    flash("Testing {} MACs for Portal({})".format(len(macs), name), "success")
 
     return redirect("/portals", code=302)
 
@@ -276,72 +1348,86 @@ def portalUpdate():
     retest = request.form.get("retest", None)
 
     if not url.endswith(".php"):
-        url = stb.getUrl(url, proxy)
+        url = stb.getUrl(url, proxy, refresh=True)  # the host may have moved
         if not url:
             logger.error("Error getting URL for Portal({})".format(name))
             flash("Error getting URL for Portal({})".format(name), "danger")
             return redirect("/portals", code=302)
+        saveUrls()
+
+    oldmacs = getPortals()[id]["macs"]
+    testmacs = [mac for mac in newmacs if retest or mac not in oldmacs.keys()]
+
+    def finish(tested):
+        def change(portals):
+            if id not in portals:
+                return None
+            # expiries of untested MACs may have been refreshed while testing
+            macs = {**oldmacs, **portals[id]["macs"]}
+            macsout = {}
+            for mac in newmacs:
+                if mac in tested:
+                    macsout[mac] = tested[mac]
+                elif mac not in testmacs:
+                    macsout[mac] = macs[mac]
+            if macsout:
+                portals[id]["enabled"] = enabled
+                portals[id]["name"] = name
+                portals[id]["url"] = url
+                portals[id]["macs"] = macsout
+                portals[id]["streams per mac"] = streamsPerMac
+                portals[id]["proxy"] = proxy
+            return macsout
+
+        macsout = updatePortals(change)
+        if macsout is None:
+            return False, "Portal({}) was removed while testing".format(name)
+
+        if len(macsout) > 0:
+            invalidateCatalogue(id)
+            logger.info("Portal({}) updated!".format(name))
+            return True, "Portal({}) updated!".format(name)
 
-    portals = getPortals()
-    oldmacs = portals[id]["macs"]
-    macsout = {}
-    deadmacs = []
-
-    for mac in newmacs:
-        if retest or mac not in oldmacs.keys():
-            token = stb.getToken(url, mac, proxy)
-            if token:
-                stb.getProfile(url, mac, token, proxy)
-                expiry = stb.getExpires(url, mac, token, proxy)
-                if expiry:
-                    macsout[mac] = expiry
-                    logger.info(
-                        "Successfully tested MAC({}) for Portal({})".format(mac, name)
-                    )
-                    flash(
-                        "Successfully tested MAC({}) for Portal({})".format(mac, name),
-                        "success",
-                    )
+        else:
+            logger.error(
+                "None of the MACs tested OK for Portal({}). Adding not successfull".format(
+                    name
+                )
+            )
+            return False, "None of the MACs tested OK for Portal({})".format(name)
 
-            if mac not in list(macsout.keys()):
-                deadmacs.append(mac)
+    if testmacs:
+        startMacJob(name, url, proxy, testmacs, finish)
+        flash("Testing {} MACs for Portal({})".format(len(testmacs), name), "success")
+    else:
+        success, message = finish({})
+        flash(message, "success" if success else "danger")
 
-        if mac in oldmacs.keys() and mac not in deadmacs:
-            macsout[mac] = oldmacs[mac]
+    return redirect("/portals", code=302)
 
-        if mac not in macsout.keys():
-            logger.error("Error testing MAC({}) for Portal({})".format(mac, name))
-            flash("Error testing MAC({}) for Portal({})".format(mac, name), "danger")
-
-    if len(macsout) > 0:
-        portals[id]["enabled"] = enabled
-        portals[id]["name"] = name
-        portals[id]["url"] = url
-        portals[id]["macs"] = macsout
-        portals[id]["streams per mac"] = streamsPerMac
-        portals[id]["proxy"] = proxy
-        savePortals(portals)
-        logger.info("Portal({}) updated!".format(name))
-        flash("Portal({}) updated!".format(name), "success")
 
-    else:
-        logger.error(
-            "None of the MACs tested OK for Portal({}). Adding not successfull".format(
-                name
-            )
-        )
+@app.route("/portal/jobs", methods=["GET"])
+@authorise
+def portalJobs():
+    return flask.jsonify(list(macJobs.values()))
 
-    return redirect("/portals", code=302)
+
+@app.route("/portal/job/<jobId>", methods=["GET"])
+@authorise
+def portalJob(jobId):
+    job = macJobs.get(jobId)
+    if not job:
+        return make_response("Job not found", 404)
+    return flask.jsonify(job)
 
 
 @app.route("/portal/remove", methods=["POST"])
 @authorise
 def portalRemove():
     id = request.form["deleteId"]
-    portals = getPortals()
-    name = portals[id]["name"]
-    del portals[id]
-    savePortals(portals)
+    name = updatePortals(lambda portals: portals.pop(id)["name"])
+    invalidateCatalogue(id)
+    removeEpg(id)
     logger.info("Portal ({}) removed!".format(name))
     flash("Portal ({}) removed!".format(name), "success")
     return redirect("/portals", code=302)
@@ -350,63 +1436,58 @@ def portalRemove():
 @app.route("/editor", methods=["GET"])
 @authorise
 def editor():
-    return render_template("editor.html")
+    return render_template("editor.html", portals=getPortals())
 
 
-@app.route("/editor_data", methods=["GET"])
-@authorise
-def editor_data():
+editorCache = {}
+
+
+def numberKey(number):
+    try:
+        return float(number)
+    except ValueError:
+        return float("inf")
+
+
+# column -> sort key of the value the editor shows, custom values first
+editorSortKeys = {
+    "enabled": lambda r: r["enabled"],
+    "channelName": lambda r: (r["customChannelName"] or r["channelName"]).lower(),
+    "genre": lambda r: (r["customGenre"] or r["genre"]).lower(),
+    "channelNumber": lambda r: numberKey(
+        r["customChannelNumber"] or r["channelNumber"]
+    ),
+    "channelId": lambda r: (r["customEpgId"] or r["portal"] + r["channelId"]).lower(),
+    "fallbackChannel": lambda r: r["fallbackChannel"].lower(),
+    "portalName": lambda r: r["portalName"].lower(),
+}
+
+
+def buildEditorRows(portals, catalogues):
     channels = []
-    portals = getPortals()
-    for portal in portals:
+    for portal in catalogues:
         if portals[portal]["enabled"] == "true":
             portalName = portals[portal]["name"]
-            url = portals[portal]["url"]
-            macs = list(portals[portal]["macs"].keys())
-            proxy = portals[portal]["proxy"]
-            enabledChannels = portals[portal].get("enabled channels", [])
-            customChannelNames = portals[portal].get("custom channel names", {})
-            customGenres = portals[portal].get("custom genres", {})
-            customChannelNumbers = portals[portal].get("custom channel numbers", {})
-            customEpgIds = portals[portal].get("custom epg ids", {})
-            fallbackChannels = portals[portal].get("fallback channels", {})
-
-            for mac in macs:
-                try:
-                    token = stb.getToken(url, mac, proxy)
-                    stb.getProfile(url, mac, token, proxy)
-                    allChannels = stb.getAllChannels(url, mac, token, proxy)
-                    genres = stb.getGenreNames(url, mac, token, proxy)
-                    break
-                except:
-                    allChannels = None
-                    genres = None
-
-            if allChannels and genres:
+            settings = getChannelSettings(portal)
+            enabledChannels = settings["enabled"]
+            customChannels = settings["channels"]
+
+            data = catalogues[portal]
+            if data:
+                allChannels = data["channels"]
+                genres = data["genres"]
                 for channel in allChannels:
                     channelId = str(channel["id"])
                     channelName = str(channel["name"])
                     channelNumber = str(channel["number"])
                     genre = str(genres.get(str(channel["tv_genre_id"])))
-                    if channelId in enabledChannels:
-                        enabled = True
-                    else:
-                        enabled = False
-                    customChannelNumber = customChannelNumbers.get(channelId)
-                    if customChannelNumber == None:
-                        customChannelNumber = ""
-                    customChannelName = customChannelNames.get(channelId)
-                    if customChannelName == None:
-                        customChannelName = ""
-                    customGenre = customGenres.get(channelId)
-                    if customGenre == None:
-                        customGenre = ""
-                    customEpgId = customEpgIds.get(channelId)
-                    if customEpgId == None:
-                        customEpgId = ""
-                    fallbackChannel = fallbackChannels.get(channelId)
-                    if fallbackChannel == None:
-                        fallbackChannel = ""
+                    enabled = channelId in enabledChannels
+                    custom = customChannels.get(channelId, {})
+                    customChannelNumber = custom.get("number", "")
+                    customChannelName = custom.get("name", "")
+                    customGenre = custom.get("genre", "")
+                    customEpgId = custom.get("epg id", "")
+                    fallbackChannel = custom.get("fallback", "")
                     channels.append(
                         {
                             "portal": portal,
@@ -439,9 +1520,93 @@ def editor_data():
                     "danger",
                 )
 
-    data = {"data": channels}
+    return channels
 
-    return flask.jsonify(data)
+
+def getEditorRows():
+    # rebuilt once per change to the config or to any catalogue
+    global editorCache
+    portals = getPortals()
+    catalogues = getCatalogues(
+        [portal for portal in portals if portals[portal]["enabled"] == "true"]
+    )
+    key = (
+        configVersion,
+        tuple(
+            (portal, data["updated"] if data else None)
+            for portal, data in catalogues.items()
+        ),
+    )
+    cached = editorCache
+    metrics.inc(
+        "stb_cache_requests_total",
+        cache="editor",
+        result="hit" if cached.get("key") == key else "miss",
+    )
+    if cached.get("key") != key:
+        rows = buildEditorRows(portals, catalogues)
+        searchText = [
+            " ".join(
+                [
+                    r["channelName"],
+                    r["customChannelName"],
+                    r["genre"],
+                    r["customGenre"],
+                    r["channelNumber"],
+                    r["customChannelNumber"],
+                ]
+            ).lower()
+            for r in rows
+        ]
+        cached = {"key": key, "rows": rows, "search": searchText}
+        editorCache = cached
+    return cached
+
+
+@app.route("/editor_data", methods=["GET"])
+@authorise
+def editor_data():
+    cached = getEditorRows()
+    rows = cached["rows"]
+    draw = request.args.get("draw")
+    if draw is None:
+        return flask.jsonify({"data": rows})
+
+    # DataTables server-side processing, only the visible page is sent
+    search = request.args.get("search[value]", "").strip().lower()
+    portal = request.args.get("portal", "")
+    enabled = request.args.get("enabled", "")
+    channels = [
+        r
+        for r, text in zip(rows, cached["search"])
+        if (not search or search in text)
+        and (not portal or r["portal"] == portal)
+        and (not enabled or r["enabled"] == (enabled == "true"))
+    ]
+
+    order = []
+    i = 0
+    while "order[{}][column]".format(i) in request.args:
+        column = request.args.get("order[{}][column]".format(i))
+        name = request.args.get("columns[{}][data]".format(column))
+        if name in editorSortKeys:
+            order.append((name, request.args.get("order[{}][dir]".format(i)) != "asc"))
+        i = i + 1
+    for name, reverse in reversed(order):
+        channels.sort(key=editorSortKeys[name], reverse=reverse)
+
+    start = max(request.args.get("start", 0, type=int), 0)
+    length = request.args.get("length", -1, type=int)
+    page = channels[start:] if length < 0 else channels[start : start + length]
+
+    return flask.jsonify(
+        {
+            "draw": int(draw),
+            "recordsTotal": len(rows),
+            "recordsFiltered": len(channels),
+            "data": page,
+        }
+    )
 
 
 @app.route("/editor/save", methods=["POST"])
@@ -453,70 +1618,77 @@ def editorSave():
     genreEdits = json.loads(request.form["genreEdits"])
     epgEdits = json.loads(request.form["epgEdits"])
     fallbackEdits = json.loads(request.form["fallbackEdits"])
-    portals = getPortals()
-    for edit in enabledEdits:
-        portal = edit["portal"]
-        channelId = edit["channel id"]
-        enabled = edit["enabled"]
-        if enabled:
-            portals[portal].setdefault("enabled channels", [])
-            portals[portal]["enabled channels"].append(channelId)
-        else:
-            portals[portal]["enabled channels"] = list(
-                filter((channelId).__ne__, portals[portal]["enabled channels"])
-            )
 
-    for edit in numberEdits:
-        portal = edit["portal"]
-        channelId = edit["channel id"]
-        customNumber = edit["custom number"]
-        if customNumber:
-            portals[portal].setdefault("custom channel numbers", {})
-            portals[portal]["custom channel numbers"].update({channelId: customNumber})
-        else:
-            portals[portal]["custom channel numbers"].pop(channelId)
-
-    for edit in nameEdits:
-        portal = edit["portal"]
-        channelId = edit["channel id"]
-        customName = edit["custom name"]
-        if customName:
-            portals[portal].setdefault("custom channel names", {})
-            portals[portal]["custom channel names"].update({channelId: customName})
-        else:
-            portals[portal]["custom channel names"].pop(channelId)
-
-    for edit in genreEdits:
-        portal = edit["portal"]
-        channelId = edit["channel id"]
-        customGenre = edit["custom genre"]
-        if customGenre:
-            portals[portal].setdefault("custom genres", {})
-            portals[portal]["custom genres"].update({channelId: customGenre})
-        else:
-            portals[portal]["custom genres"].pop(channelId)
-
-    for edit in epgEdits:
-        portal = edit["portal"]
-        channelId = edit["channel id"]
-        customEpgId = edit["custom epg id"]
-        if customEpgId:
-            portals[portal].setdefault("custom epg ids", {})
-            portals[portal]["custom epg ids"].update({channelId: customEpgId})
-        else:
-            portals[portal]["custom epg ids"].pop(channelId)
-
-    for edit in fallbackEdits:
-        portal = edit["portal"]
-        channelId = edit["channel id"]
-        channelName = edit["channel name"]
-        if channelName:
-            portals[portal].setdefault("fallback channels", {})
-            portals[portal]["fallback channels"].update({channelId: channelName})
-        else:
-            portals[portal]["fallback channels"].pop(channelId)
+    def change(portals):
+        enabledChannels = {}  # ordered sets, so re-enabling does not add duplicates
+        for edit in enabledEdits:
+            portal = edit["portal"]
+            channelId = edit["channel id"]
+            enabled = edit["enabled"]
+            if portal not in enabledChannels:
+                enabledChannels[portal] = dict.fromkeys(
+                    portals[portal].get("enabled channels", [])
+                )
+            if enabled:
+                enabledChannels[portal][channelId] = None
+            else:
+                enabledChannels[portal].pop(channelId, None)
+        for portal, channelIds in enabledChannels.items():
+            portals[portal]["enabled channels"] = list(channelIds)
+
+        for edit in numberEdits:
+            portal = edit["portal"]
+            channelId = edit["channel id"]
+            customNumber = edit["custom number"]
+            if customNumber:
+                portals[portal].setdefault("custom channel numbers", {})
+                portals[portal]["custom channel numbers"].update(
+                    {channelId: customNumber}
+                )
+            else:
+                portals[portal].get("custom channel numbers", {}).pop(channelId, None)
+
+        for edit in nameEdits:
+            portal = edit["portal"]
+            channelId = edit["channel id"]
+            customName = edit["custom name"]
+            if customName:
+                portals[portal].setdefault("custom channel names", {})
+                portals[portal]["custom channel names"].update({channelId: customName})
+            else:
+                portals[portal].get("custom channel names", {}).pop(channelId, None)
+
+        for edit in genreEdits:
+            portal = edit["portal"]
+            channelId = edit["channel id"]
+            customGenre = edit["custom genre"]
+            if customGenre:
+                portals[portal].setdefault("custom genres", {})
+                portals[portal]["custom genres"].update({channelId: customGenre})
+            else:
+                portals[portal].get("custom genres", {}).pop(channelId, None)
+
+        for edit in epgEdits:
+            portal = edit["portal"]
+            channelId = edit["channel id"]
+            customEpgId = edit["custom epg id"]
+            if customEpgId:
+                portals[portal].setdefault("custom epg ids", {})
+                portals[portal]["custom epg ids"].update({channelId: customEpgId})
+            else:
+                portals[portal].get("custom epg ids", {}).pop(channelId, None)
+
+        for edit in fallbackEdits:
+            portal = edit["portal"]
+            channelId = edit["channel id"]
+            channelName = edit["channel name"]
+            if channelName:
+                portals[portal].setdefault("fallback channels", {})
+                portals[portal]["fallback channels"].update({channelId: channelName})
+            else:
+                portals[portal].get("fallback channels", {}).pop(channelId, None)
 
-    savePortals(portals)
+    updatePortals(change)
     logger.info("Playlist config saved!")
     flash("Playlist config saved!", "success")
 
@@ -526,16 +1698,16 @@ def editorSave():
 @app.route("/editor/reset", methods=["POST"])
 @authorise
 def editorReset():
-    portals = getPortals()
-    for portal in portals:
-        portals[portal]["enabled channels"] = []
-        portals[portal]["custom channel numbers"] = {}
-        portals[portal]["custom channel names"] = {}
-        portals[portal]["custom genres"] = {}
-        portals[portal]["custom epg ids"] = {}
-        portals[portal]["fallback channels"] = {}
-
-    savePortals(portals)
+    def change(portals):
+        for portal in portals:
+            portals[portal]["enabled channels"] = []
+            portals[portal]["custom channel numbers"] = {}
+            portals[portal]["custom channel names"] = {}
+            portals[portal]["custom genres"] = {}
+            portals[portal]["custom epg ids"] = {}
+            portals[portal]["fallback channels"] = {}
+
+    updatePortals(change)
     logger.info("Playlist reset!")
     flash("Playlist reset!", "success")
 
@@ -566,273 +1738,353 @@ def save():
     return redirect("/settings", code=302)
 
 
-@app.route("/playlist", methods=["GET"])
-@authorise
-def playlist():
+playlistCache = {}
+
+
+def renderPlaylist(portals, catalogues):
+    settings = getSettings()
+    useNumbers = settings.get("use channel numbers", "true") == "true"
+    useGenres = settings.get("use channel genres", "true") == "true"
     channels = []
-    portals = getPortals()
-    for portal in portals:
+    for portal in catalogues:
         if portals[portal]["enabled"] == "true":
-            enabledChannels = portals[portal].get("enabled channels", [])
+            channelSettings = getChannelSettings(portal)
+            enabledChannels = channelSettings["enabled"]
             if len(enabledChannels) != 0:
                 name = portals[portal]["name"]
-                url = portals[portal]["url"]
-                macs = list(portals[portal]["macs"].keys())
-                proxy = portals[portal]["proxy"]
-                customChannelNames = portals[portal].get("custom channel names", {})
-                customGenres = portals[portal].get("custom genres", {})
-                customChannelNumbers = portals[portal].get("custom channel numbers", {})
-                customEpgIds = portals[portal].get("custom epg ids", {})
-
-                for mac in macs:
-                    try:
-                        token = stb.getToken(url, mac, proxy)
-                        stb.getProfile(url, mac, token, proxy)
-                        allChannels = stb.getAllChannels(url, mac, token, proxy)
-                        genres = stb.getGenreNames(url, mac, token, proxy)
-                        break
-                    except:
-                        allChannels = None
-                        genres = None
+                customChannels = channelSettings["channels"]
 
-                if allChannels and genres:
+                data = catalogues[portal]
+                if data:
+                    allChannels = data["channels"]
+                    genres = data["genres"]
                     for channel in allChannels:
                         channelId = str(channel.get("id"))
                         if channelId in enabledChannels:
-                            channelName = customChannelNames.get(channelId)
+                            custom = customChannels.get(channelId, {})
+                            channelName = custom.get("name")
                             if channelName == None:
                                 channelName = str(channel.get("name"))
-                            genre = customGenres.get(channelId)
+                            genre = custom.get("genre")
                             if genre == None:
                                 genreId = str(channel.get("tv_genre_id"))
                                 genre = str(genres.get(genreId))
-                            channelNumber = customChannelNumbers.get(channelId)
+                            channelNumber = custom.get("number")
                             if channelNumber == None:
                                 channelNumber = str(channel.get("number"))
-                            epgId = customEpgIds.get(channelId)
+                            epgId = custom.get("epg id")
                             if epgId == None:
                                 epgId = portal + channelId
                             channels.append(
-                                "#EXTINF:-1"
-                                + ' tvg-id="'
-                                + epgId
-                                + (
-                                    '" tvg-chno="' + channelNumber
-                                    if getSettings().get("use channel numbers", "true")
-                                    == "true"
-                                    else ""
-                                )
-                                + (
-                                    '" group-title="' + genre
-                                    if getSettings().get("use channel genres", "true")
-                                    == "true"
-                                    else ""
+                                (
+                                    genre,
+                                    channelNumber,
+                                    channelName,
+                                    epgId,
+                                    portal,
+                                    channelId,
                                 )
-                                + '",'
-                                + channelName
-                                + "\n"
-                                + "http://"
-                                + host
-                                + "/play/"
-                                + portal
-                                + "/"
-                                + channelId
                             )
                 else:
                     logger.error("Error making playlist for {}, skipping".format(name))
 
-    if getSettings().get("sort playlist by channel name", "true") == "true":
-        channels.sort(key=lambda k: k.split(",")[1].split("\n")[0])
-    if getSettings().get("use channel numbers", "true") == "true":
-        if getSettings().get("sort playlist by channel number", "false") == "true":
-            channels.sort(key=lambda k: k.split('tvg-chno="')[1].split('"')[0])
-    if getSettings().get("use channel genres", "true") == "true":
-        if getSettings().get("sort playlist by channel genre", "false") == "true":
-            channels.sort(key=lambda k: k.split('group-title="')[1].split('"')[0])
+    # genre, then number, then name, as if sorted by each in turn
+    sortKey = []
+    if useGenres and settings.get("sort playlist by channel genre", "false") == "true":
+        sortKey.append(0)
+    if (
+        useNumbers
+        and settings.get("sort playlist by channel number", "false") == "true"
+    ):
+        sortKey.append(1)
+    if settings.get("sort playlist by channel name", "true") == "true":
+        sortKey.append(2)
+    if sortKey:
+        channels.sort(key=lambda c: [c[i] for i in sortKey])
+
+    lines = []
+    for genre, channelNumber, channelName, epgId, portal, channelId in channels:
+        lines.append(
+            '#EXTINF:-1 tvg-id="{}{}{}",{}\nhttp://{}/play/{}/{}'.format(
+                epgId,
+                '" tvg-chno="' + channelNumber if useNumbers else "",
+                '" group-title="' + genre if useGenres else "",
+                channelName,
+                host,
+                portal,
+                channelId,
+            )
+        )
+    return "#EXTM3U \n" + "\n".join(lines)
 
-    playlist = "#EXTM3U \n"
-    playlist = playlist + "\n".join(channels)
 
-    return Response(playlist, mimetype="text/plain")
+@app.route("/playlist", methods=["GET"])
+@authorise
+def playlist():
+    global playlistCache
+    portals = getPortals()
+    catalogues = getCatalogues(
+        [
+            portal
+            for portal in portals
+            if portals[portal]["enabled"] == "true"
+            and len(getChannelSettings(portal)["enabled"]) != 0
+        ]
+    )
+
+    # rendered once per change to the config or to any catalogue
+    key = (
+        configVersion,
+        tuple(
+            (portal, data["updated"] if data else None)
+            for portal, data in catalogues.items()
+        ),
+    )
+    cached = playlistCache
+    metrics.inc(
+        "stb_cache_requests_total",
+        cache="playlist",
+        result="hit" if cached.get("key") == key else "miss",
+    )
+    if cached.get("key") != key:
+        body = renderPlaylist(portals, catalogues).encode()
+        etag = hashlib.sha1(body).hexdigest()
+        cached = {
+            "key": key,
+            "body": body,
+            "gzip": gzip.compress(body),
+            "etag": etag,
+            # unchanged content keeps its date so clients still get a 304
+            "modified": (
+                cached["modified"]
+                if cached.get("etag") == etag
+                else datetime.now(timezone.utc)
+            ),
+        }
+        playlistCache = cached
+
+    if "gzip" in request.accept_encodings:
+        response = Response(cached["gzip"], mimetype="text/plain")
+        response.headers["Content-Encoding"] = "gzip"
+        response.set_etag(cached["etag"] + "-gzip")
+    else:
+        response = Response(cached["body"], mimetype="text/plain")
+        response.set_etag(cached["etag"])
+    response.vary.add("Accept-Encoding")
+    response.last_modified = cached["modified"]
+    return response.make_conditional(request)
 
 
 @app.route("/xmltv", methods=["GET"])
 @authorise
 def xmltv():
-    channels = ET.Element("tv")
-    programmes = ET.Element("tv")
     portals = getPortals()
-    for portal in portals:
-        if portals[portal]["enabled"] == "true":
-            enabledChannels = portals[portal].get("enabled channels", [])
-            if len(enabledChannels) != 0:
-                name = portals[portal]["name"]
-                url = portals[portal]["url"]
-                macs = list(portals[portal]["macs"].keys())
-                proxy = portals[portal]["proxy"]
-                customChannelNames = portals[portal].get("custom channel names", {})
-                customEpgIds = portals[portal].get("custom epg ids", {})
-
-                for mac in macs:
+    catalogues = getCatalogues(
+        [
+            portal
+            for portal in portals
+            if portals[portal]["enabled"] == "true"
+            and len(getChannelSettings(portal)["enabled"]) != 0
+        ]
+    )
+    fanOut(ensureEpg, [portal for portal in catalogues if portal not in epgUpdated])
+
+    def formatTime(timestamp):
+        return datetime.utcfromtimestamp(timestamp).strftime("%Y%m%d%H%M%S") + " +0000"
+
+    def generate():
+        guide = []
+        out = ["<?xml version='1.0' encoding='utf-8'?>\n<tv>"]
+        for portal in catalogues:
+            settings = getChannelSettings(portal)
+            enabledChannels = settings["enabled"]
+            name = portals[portal]["name"]
+            customChannels = settings["channels"]
+
+            data = catalogues[portal]
+            if data:
+                for c in data["channels"]:
                     try:
-                        token = stb.getToken(url, mac, proxy)
-                        stb.getProfile(url, mac, token, proxy)
-                        allChannels = stb.getAllChannels(url, mac, token, proxy)
-                        epg = stb.getEpg(url, mac, token, 24, proxy)
-                        break
+                        channelId = str(c.get("id"))
+                        if channelId in enabledChannels:
+                            custom = customChannels.get(channelId, {})
+                            channelName = custom.get("name")
+                            if channelName == None:
+                                channelName = str(c.get("name"))
+                            epgId = custom.get("epg id")
+                            if epgId == None:
+                                epgId = portal + channelId
+                            channelEle = ET.Element("channel", id=epgId)
+                            ET.SubElement(channelEle, "display-name").text = channelName
+                            ET.SubElement(channelEle, "icon", src=c.get("logo"))
+                            out.append(ET.tostring(channelEle, encoding="unicode"))
+                            guide.append((portal, channelId, epgId))
                     except:
-                        allChannels = None
-                        epg = None
-
-                if allChannels and epg:
-                    for c in allChannels:
-                        try:
-                            channelId = c.get("id")
-                            if str(channelId) in enabledChannels:
-                                channelName = customChannelNames.get(str(channelId))
-                                if channelName == None:
-                                    channelName = str(c.get("name"))
-                                epgId = customEpgIds.get(channelId)
-                                if epgId == None:
-                                    epgId = portal + channelId
-                                channelEle = ET.SubElement(
-                                    channels, "channel", id=epgId
-                                )
-                                ET.SubElement(
-                                    channelEle, "display-name"
-                                ).text = channelName
-                                ET.SubElement(channelEle, "icon", src=c.get("logo"))
-                                for p in epg.get(channelId):
-                                    try:
-                                        start = (
-                                            datetime.utcfromtimestamp(
-                                                p.get("start_timestamp")
-                                            ).strftime("%Y%m%d%H%M%S")
-                                            + " +0000"
-                                        )
-                                        stop = (
-                                            datetime.utcfromtimestamp(
-                                                p.get("stop_timestamp")
-                                            ).strftime("%Y%m%d%H%M%S")
-                                            + " +0000"
-                                        )
-                                        programmeEle = ET.SubElement(
-                                            programmes,
-                                            "programme",
-                                            start=start,
-                                            stop=stop,
-                                            channel=epgId,
-                                        )
-                                        ET.SubElement(
-                                            programmeEle, "title"
-                                        ).text = p.get("name")
-                                        ET.SubElement(
-                                            programmeEle, "desc"
-                                        ).text = p.get("descr")
-                                    except:
-                                        pass
-                        except:
-                            pass
-                else:
-                    logger.error("Error making XMLTV for {}, skipping".format(name))
-
-    xmltv = channels
-    for programme in programmes.iter("programme"):
-        xmltv.append(programme)
+                        pass
+            else:
+                logger.error("Error making XMLTV for {}, skipping".format(name))
+            yield "".join(out)
+            out = []
+
+        with closing(sqlite3.connect(epgFile, timeout=30)) as db:
+            for portal, channelId, epgId in guide:
+                for start, stop, title, descr in db.execute(
+                    "SELECT start, stop, title, descr FROM programmes "
+                    "WHERE portal = ? AND channel = ? AND stop > ? ORDER BY start",
+                    (portal, channelId, int(time.time())),
+                ):
+                    programmeEle = ET.Element(
+                        "programme",
+                        start=formatTime(start),
+                        stop=formatTime(stop),
+                        channel=epgId,
+                    )
+                    ET.SubElement(programmeEle, "title").text = title
+                    ET.SubElement(programmeEle, "desc").text = descr
+                    out.append(ET.tostring(programmeEle, encoding="unicode"))
+                if len(out) > 1000:
+                    yield "".join(out)
+                    out = []
+        out.append("</tv>")
+        yield "".join(out)
 
-    return Response(
-        ET.tostring(xmltv, encoding="unicode", xml_declaration=True),
-        mimetype="text/xml",
-    )
+    return Response(generate(), mimetype="text/xml")
 
 
 @app.route("/play/<portalId>/<channelId>", methods=["GET"])
 def channel(portalId, channelId):
-    def streamData():
-        def occupy():
-            occupied.setdefault(portalId, [])
-            occupied.get(portalId, []).append(
-                {
-                    "mac": mac,
-                    "channel id": channelId,
-                    "channel name": channelName,
-                    "client": ip,
-                    "portal name": portalName,
-                    "start time": startTime,
-                }
-            )
-            logger.info("Occupied Portal({}):MAC({})".format(portalId, mac))
-
-        def unoccupy():
-            occupied.get(portalId, []).remove(
-                {
-                    "mac": mac,
-                    "channel id": channelId,
-                    "channel name": channelName,
-                    "client": ip,
-                    "portal name": portalName,
-                    "start time": startTime,
-                }
-            )
-            logger.info("Unoccupied Portal({}):MAC({})".format(portalId, mac))
+    trace = {
+        "time": time.time(),
+        "portal": portalId,
+        "portal name": None,
+        "channel id": channelId,
+        "channel name": None,
+        "client": request.remote_addr,
+        "macs": [],
+        "fallbacks": [],
+        "result": "failed",
+        "total ms": None,
+        "first byte ms": None,
+    }
+    trace["steps"] = metrics.startTrace()
+    try:
+        return tune(portalId, channelId, trace)
+    finally:
+        metrics.stopTrace()
+        recordTune(trace)
+
+
+def tune(portalId, channelId, trace):
+    def streamData(handle):
+        def put(chunk):
+            # a slow client fills the queue, which pauses reading and ffmpeg
+            while not stopped.is_set():
+                try:
+                    chunks.put(chunk, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def reader():
+            try:
+                for chunk in packetChunks(ffmpeg_sp.stdout.readinto1, chunkSize):
+                    if not put(chunk):
+                        return
+            finally:
+                put(b"")  # end of stream, also if reading failed
+
+        stopped = threading.Event()
+        chunks = queue.Queue(maxsize=hubBufferChunks)
+        chunkSize = getChunkSize()
 
         try:
-            startTime = datetime.now(timezone.utc).timestamp()
-            occupy()
+            startTime = time.time()
             with subprocess.Popen(
                 ffmpegcmd,
                 stdin=subprocess.DEVNULL,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.DEVNULL,
             ) as ffmpeg_sp:
+                readerThread = threading.Thread(target=reader, daemon=True)
+                readerThread.start()
                 while True:
-                    chunk = ffmpeg_sp.stdout.read(1024)
+                    try:
+                        chunk = chunks.get(timeout=1)
+                    except queue.Empty:
+                        if readerThread.is_alive() or not chunks.empty():
+                            continue
+                        chunk = b""  # the reader died without ending the stream
+                    if startTime and chunk:
+                        recordFirstByte(trace)
+                        metrics.observe(
+                            "stb_tune_phase_seconds",
+                            time.time() - startTime,
+                            phase="first_byte",
+                            portal=portalId,
+                        )
+                        startTime = None
                     if len(chunk) == 0:
-                        if ffmpeg_sp.poll() != 0:
-                            logger.info("Ffmpeg closed with error({}). Moving MAC({}) for Portal({})".format(str(ffmpeg_sp.poll()), mac, portalName))
+                        returncode = ffmpeg_sp.wait()
+                        metrics.inc("stb_ffmpeg_exits_total", code=returncode)
+                        if returncode != 0:
+                            logger.info(
+                                "Ffmpeg closed with error({}). Moving MAC({}) for Portal({})".format(
+                                    str(returncode), mac, portalName
+                                )
+                            )
+                            stb.invalidateSession(url, mac)
+                            recordMacHealth(portalId, mac, False)
                             moveMac(portalId, mac)
                         break
+                    metrics.inc(
+                        "stb_relayed_bytes_total", len(chunk), portal=portalId, mac=mac
+                    )
                     yield chunk
         except:
             pass
         finally:
-            unoccupy()
+            stopped.set()
+            slots.release(handle)
             ffmpeg_sp.kill()
 
-    def testStream():
-        timeout = int(getSettings()["ffmpeg timeout"]) * int(1000000)
-        ffprobecmd = ["ffprobe", "-timeout", str(timeout), "-i", link]
-
-        if proxy:
-            ffprobecmd.insert(1, "-http_proxy")
-            ffprobecmd.insert(2, proxy)
-
-        with subprocess.Popen(
-            ffprobecmd,
-            stdin=subprocess.DEVNULL,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        ) as ffprobe_sb:
-            ffprobe_sb.communicate()
-            if ffprobe_sb.returncode == 0:
-                return True
+    def shareStream(ffmpegcmd):
+        with hubsLock:
+            hub = hubs.get((portalId, channelId))
+            if not hub or hub.closed or hub.stopped:
+                hub = StreamHub(
+                    portalId,
+                    channelId,
+                    ffmpegcmd,
+                    link,
+                    proxy,
+                    url,
+                    macPortalId,
+                    mac,
+                    portalName,
+                    handle,
+                )
+                hub.trace = trace
+                hubs[(portalId, channelId)] = hub
+                trace["result"] = "ffmpeg" if ffmpegcmd else "relay"
             else:
-                return False
-
-    def isMacFree():
-        count = 0
-        for i in occupied.get(portalId, []):
-            if i["mac"] == mac:
-                count = count + 1
-        if count < streamsPerMac:
-            return True
-        else:
-            return False
+                slots.release(handle)  # another request started it meanwhile
+                trace["result"] = "shared"
+        return hub.serve(ip)
+
+    def slotEntry():
+        return {
+            "channel id": channelId,
+            "channel name": channelName,
+            "client": ip,
+            "portal name": portalName,
+        }
 
     portal = getPortals().get(portalId)
     portalName = portal.get("name")
+    trace["portal name"] = portalName
     url = portal.get("url")
-    macs = list(portal["macs"].keys())
+    macs = sortMacs(portalId, list(portal["macs"].keys()))
     streamsPerMac = int(portal.get("streams per mac"))
     proxy = portal.get("proxy")
     web = request.args.get("web")
@@ -842,39 +2094,50 @@ def channel(portalId, channelId):
         "IP({}) requested Portal({}):Channel({})".format(ip, portalId, channelId)
     )
 
+    if not web:
+        watched[(portalId, channelId)] = time.time()
+        hub = getHub(portalId, channelId)
+        if hub:
+            logger.info(
+                "Sharing stream for Portal({}):Channel({})".format(portalId, channelId)
+            )
+            trace["result"] = "shared"
+            return hub.serve(ip)
+
     freeMac = False
+    macPortalId = portalId
+    channelName = None
+
+    c = getChannel(portalId, channelId)
+    if c:
+        channelName = (
+            getChannelSettings(portalId)["channels"].get(channelId, {}).get("name")
+        )
+        if channelName == None:
+            channelName = c["name"]
+    trace["channel name"] = channelName
 
     for mac in macs:
-        channels = None
         cmd = None
         link = None
-        if streamsPerMac == 0 or isMacFree():
-            logger.info(
-                "Trying Portal({}):MAC({}):Channel({})".format(portalId, mac, channelId)
-            )
-            freeMac = True
-            token = stb.getToken(url, mac, proxy)
-            if token:
-                stb.getProfile(url, mac, token, proxy)
-                channels = stb.getAllChannels(url, mac, token, proxy)
-
-        if channels:
-            for c in channels:
-                if str(c["id"]) == channelId:
-                    channelName = portal.get("custom channel names", {}).get(channelId)
-                    if channelName == None:
-                        channelName = c["name"]
-                    cmd = c["cmd"]
-                    break
+        handle = slots.acquire(portalId, mac, streamsPerMac, slotEntry())
+        if not handle:
+            continue  # busy rather than broken, so not moved or penalised
+        logger.info(
+            "Trying Portal({}):MAC({}):Channel({})".format(portalId, mac, channelId)
+        )
+        freeMac = True
+        trace["macs"].append(mac)
+        if c:
+            cmd = c["cmd"]
 
         if cmd:
-            if "http://localhost/" in cmd:
-                link = stb.getLink(url, mac, token, cmd, proxy)
-            else:
-                link = cmd.split(" ")[1]
+            link = resolveLink(portalId, url, mac, cmd, proxy)
 
         if link:
-            if getSettings().get("test streams", "true") == "false" or testStream():
+            if getSettings().get("test streams", "true") == "false" or isStreamOk(
+                portalId, channelId, link, proxy
+            ):
                 if web:
                     ffmpegcmd = [
                         "ffmpeg",
@@ -894,10 +2157,18 @@ def channel(portalId, channelId):
                     if proxy:
                         ffmpegcmd.insert(1, "-http_proxy")
                         ffmpegcmd.insert(2, proxy)
-                    return Response(streamData(), mimetype="application/octet-stream")
+                    response = Response(
+                        streamData(handle), mimetype="application/octet-stream"
+                    )
+                    response.call_on_close(lambda: slots.release(handle))
+                    trace["result"] = "web"
+                    return response
 
                 else:
-                    if getSettings().get("stream method", "ffmpeg") == "ffmpeg":
+                    streamMethod = getSettings().get("stream method", "ffmpeg")
+                    if streamMethod == "relay" and ".m3u8" not in link:
+                        return shareStream(None)
+                    elif streamMethod in ["ffmpeg", "relay"]:
                         ffmpegcmd = str(getSettings()["ffmpeg command"])
                         ffmpegcmd = ffmpegcmd.replace("<url>", link)
                         ffmpegcmd = ffmpegcmd.replace(
@@ -910,17 +2181,20 @@ def channel(portalId, channelId):
                             ffmpegcmd = ffmpegcmd.replace("-http_proxy <proxy>", "")
                         " ".join(ffmpegcmd.split())  # cleans up multiple whitespaces
                         ffmpegcmd = ffmpegcmd.split()
-                        return Response(
-                            streamData(), mimetype="application/octet-stream"
-                        )
+                        return shareStream(ffmpegcmd)
                     else:
+                        slots.release(handle)
                         logger.info("Redirect sent")
+                        trace["result"] = "redirect"
                         return redirect(link)
 
+        slots.release(handle)
         logger.info(
             "Unable to connect to Portal({}) using MAC({})".format(portalId, mac)
         )
         logger.info("Moving MAC({}) for Portal({})".format(mac, portalName))
+        stb.invalidateSession(url, mac)
+        recordMacHealth(portalId, mac, False)
         moveMac(portalId, mac)
 
         if not getSettings().get("try all macs", "false") == "true":
@@ -934,99 +2208,55 @@ def channel(portalId, channelId):
         )
 
         portals = getPortals()
-        for portal in portals:
-            if portals[portal]["enabled"] == "true":
-                fallbackChannels = portals[portal]["fallback channels"]
-                if channelName in fallbackChannels.values():
-                    url = portals[portal].get("url")
-                    macs = list(portals[portal]["macs"].keys())
-                    proxy = portals[portal].get("proxy")
-                    for mac in macs:
-                        channels = None
-                        cmd = None
-                        link = None
-                        if streamsPerMac == 0 or isMacFree():
-                            for k, v in fallbackChannels.items():
-                                if v == channelName:
-                                    try:
-                                        token = stb.getToken(url, mac, proxy)
-                                        stb.getProfile(url, mac, token, proxy)
-                                        channels = stb.getAllChannels(
-                                            url, mac, token, proxy
-                                        )
-                                    except:
-                                        logger.info(
-                                            "Unable to connect to fallback Portal({}) using MAC({})".format(
-                                                portalId, mac
-                                            )
-                                        )
-                                    if channels:
-                                        fChannelId = k
-                                        for c in channels:
-                                            if str(c["id"]) == fChannelId:
-                                                cmd = c["cmd"]
-                                                break
-                                        if cmd:
-                                            if "http://localhost/" in cmd:
-                                                link = stb.getLink(
-                                                    url, mac, token, cmd, proxy
-                                                )
-                                            else:
-                                                link = cmd.split(" ")[1]
-                                            if link:
-                                                if testStream():
-                                                    logger.info(
-                                                        "Fallback found for Portal({}):Channel({})".format(
-                                                            portalId, channelId
-                                                        )
-                                                    )
-                                                    if (
-                                                        getSettings().get(
-                                                            "stream method", "ffmpeg"
-                                                        )
-                                                        == "ffmpeg"
-                                                    ):
-                                                        ffmpegcmd = str(
-                                                            getSettings()[
-                                                                "ffmpeg command"
-                                                            ]
-                                                        )
-                                                        ffmpegcmd = ffmpegcmd.replace(
-                                                            "<url>", link
-                                                        )
-                                                        ffmpegcmd = ffmpegcmd.replace(
-                                                            "<timeout>",
-                                                            str(
-                                                                int(
-                                                                    getSettings()[
-                                                                        "ffmpeg timeout"
-                                                                    ]
-                                                                )
-                                                                * int(1000000)
-                                                            ),
-                                                        )
-                                                        if proxy:
-                                                            ffmpegcmd = (
-                                                                ffmpegcmd.replace(
-                                                                    "<proxy>", proxy
-                                                                )
-                                                            )
-                                                        else:
-                                                            ffmpegcmd = ffmpegcmd.replace(
-                                                                "-http_proxy <proxy>",
-                                                                "",
-                                                            )
-                                                        " ".join(
-                                                            ffmpegcmd.split()
-                                                        )  # cleans up multiple whitespaces
-                                                        ffmpegcmd = ffmpegcmd.split()
-                                                        return Response(
-                                                            streamData(),
-                                                            mimetype="application/octet-stream",
-                                                        )
-                                                    else:
-                                                        logger.info("Redirect sent")
-                                                        return redirect(link)
+        for fPortalId, fChannelId in fallbackIndex.get(channelName, []):
+            if portals[fPortalId]["enabled"] != "true":
+                continue
+            c = getChannel(fPortalId, fChannelId)
+            if not c:
+                continue
+            trace["fallbacks"].append(portals[fPortalId]["name"] + ":" + c["name"])
+            url = portals[fPortalId].get("url")
+            macs = sortMacs(fPortalId, list(portals[fPortalId]["macs"].keys()))
+            proxy = portals[fPortalId].get("proxy")
+            macPortalId = fPortalId
+            portalName = portals[fPortalId].get("name")
+            limit = int(portals[fPortalId].get("streams per mac"))
+            for mac in macs:
+                link = None
+                handle = slots.acquire(fPortalId, mac, limit, slotEntry())
+                if handle:
+                    trace["macs"].append(mac)
+                    link = resolveLink(fPortalId, url, mac, c["cmd"], proxy)
+                if not link or not isStreamOk(fPortalId, fChannelId, link, proxy):
+                    slots.release(handle)
+                else:
+                    logger.info(
+                        "Fallback found for Portal({}):Channel({})".format(
+                            portalId, channelId
+                        )
+                    )
+                    streamMethod = getSettings().get("stream method", "ffmpeg")
+                    if streamMethod == "relay" and ".m3u8" not in link:
+                        return shareStream(None)
+                    elif streamMethod in ["ffmpeg", "relay"]:
+                        ffmpegcmd = str(getSettings()["ffmpeg command"])
+                        ffmpegcmd = ffmpegcmd.replace("<url>", link)
+                        ffmpegcmd = ffmpegcmd.replace(
+                            "<timeout>",
+                            str(int(getSettings()["ffmpeg timeout"]) * int(1000000)),
+                        )
+                        if proxy:
+                            ffmpegcmd = ffmpegcmd.replace("<proxy>", proxy)
+                        else:
+                            ffmpegcmd = ffmpegcmd.replace("-http_proxy <proxy>", "")
+                        " ".join(ffmpegcmd.split())  # cleans up multiple whitespaces
+                        ffmpegcmd = ffmpegcmd.split()
+                        return shareStream(ffmpegcmd)
+                    else:
+                        slots.release(handle)
+                        logger.info("Redirect sent")
+                        trace["result"] = "redirect"
+                        return redirect(link)
 
     if freeMac:
         logger.info(
@@ -1045,21 +2275,81 @@ def channel(portalId, channelId):
 @app.route("/dashboard")
 @authorise
 def dashboard():
-    return render_template("dashboard.html")
+    # each open event stream holds a worker, so waitress dashboards poll instead
+    return render_template("dashboard.html", live=server == "gevent")
+
+
+@app.route("/tunes")
+@authorise
+def recentTunes():
+    return flask.jsonify(list(tunes))
 
 
 @app.route("/streaming")
 @authorise
 def streaming():
-    return flask.jsonify(occupied)
+    return flask.jsonify(slots.snapshot())
+
+
+@app.route("/metrics")
+@authorise
+def metricsEndpoint():
+    metrics.clear("stb_active_streams")
+    for (portalId, mac), count in slots.activeCounts().items():
+        metrics.setGauge("stb_active_streams", count, portal=portalId, mac=mac)
+    metrics.setGauge("stb_stream_hubs", len(hubs))
+    for name in ["connections", "idle", "requests"]:
+        metrics.clear("stb_portal_pool_" + name)
+    for pool in stb.poolStats():
+        labels = {"host": pool["host"], "proxy": pool["proxy"]}
+        metrics.setGauge("stb_portal_pool_connections", pool["connections"], **labels)
+        metrics.setGauge("stb_portal_pool_idle", pool["idle"], **labels)
+        metrics.setGauge("stb_portal_pool_requests", pool["requests"], **labels)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/log")
 @authorise
 def log():
-    with open("STB-Proxy.log") as f:
-        log = f.read()
-    return log
+    # only the part after offset, the next offset is sent in X-Log-Offset
+    log, offset = readLogTail(request.args.get("offset", type=int))
+    response = Response(log, mimetype="text/plain")
+    response.headers["X-Log-Offset"] = str(offset)
+    return response
+
+
+@app.route("/events")
+@authorise
+def events():
+    # Server-Sent Events: log lines and stream changes as they happen
+    def message(kind, data):
+        return "event: {}\ndata: {}\n\n".format(kind, json.dumps(data))
+
+    if server != "gevent":
+        return make_response("Events need SERVER=gevent, poll /log instead", 404)
+
+    def generate(updates):
+        yield message("streams", slots.snapshot())
+        yield message("tunes", list(tunes))
+        yield message("tail", readLogTail()[0])
+        for batch in updates:
+            if not batch:
+                yield ": keepalive\n\n"
+                continue
+            lines = [data for kind, data in batch if kind == "log"]
+            if lines:
+                yield message("log", "\n".join(lines) + "\n")
+            if any(kind == "streams" for kind, data in batch):
+                yield message("streams", slots.snapshot())
+            if any(kind == "tunes" for kind, data in batch):
+                yield message("tunes", list(tunes))
+
+    # follow before reading the tail so no log line falls between the two
+    return Response(
+        generate(feed.follow()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # HD Homerun #
@@ -1127,34 +2417,33 @@ def status():
 def lineup():
     lineup = []
     portals = getPortals()
-    for portal in portals:
+    catalogues = getCatalogues(
+        [
+            portal
+            for portal in portals
+            if portals[portal]["enabled"] == "true"
+            and len(getChannelSettings(portal)["enabled"]) != 0
+        ]
+    )
+    for portal in catalogues:
         if portals[portal]["enabled"] == "true":
-            enabledChannels = portals[portal].get("enabled channels", [])
+            settings = getChannelSettings(portal)
+            enabledChannels = settings["enabled"]
             if len(enabledChannels) != 0:
                 name = portals[portal]["name"]
-                url = portals[portal]["url"]
-                macs = list(portals[portal]["macs"].keys())
-                proxy = portals[portal]["proxy"]
-                customChannelNames = portals[portal].get("custom channel names", {})
-                customChannelNumbers = portals[portal].get("custom channel numbers", {})
-
-                for mac in macs:
-                    try:
-                        token = stb.getToken(url, mac, proxy)
-                        stb.getProfile(url, mac, token, proxy)
-                        allChannels = stb.getAllChannels(url, mac, token, proxy)
-                        break
-                    except:
-                        allChannels = None
+                customChannels = settings["channels"]
 
-                if allChannels:
+                data = catalogues[portal]
+                if data:
+                    allChannels = data["channels"]
                     for channel in allChannels:
                         channelId = str(channel.get("id"))
                         if channelId in enabledChannels:
-                            channelName = customChannelNames.get(channelId)
+                            custom = customChannels.get(channelId, {})
+                            channelName = custom.get("name")
                             if channelName == None:
                                 channelName = str(channel.get("name"))
-                            channelNumber = customChannelNumbers.get(channelId)
+                            channelNumber = custom.get("number")
                             if channelNumber == None:
                                 channelNumber = str(channel.get("number"))
 
@@ -1178,7 +2467,20 @@ def lineup():
 
 if __name__ == "__main__":
     config = loadConfig()
+    configurePortalClients()
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))  # flush config on stop
+    loadUrls()
+    indexChannels()
+    initEpg()
+    threading.Thread(target=catalogueRefresher, daemon=True).start()
+    threading.Thread(target=streamTester, daemon=True).start()
+    threading.Thread(target=macHealthChecker, daemon=True).start()
     if "TERM_PROGRAM" in os.environ.keys() and os.environ["TERM_PROGRAM"] == "vscode":
         app.run(host="0.0.0.0", port=8001, debug=True)
+    elif server == "gevent":
+        from gevent.pywsgi import WSGIServer
+
+        logger.info("Serving with gevent")
+        WSGIServer(("0.0.0.0", 8001), app, log=None).serve_forever()
     else:
-        waitress.serve(app, port=8001, _quiet=True, threads=24)
\ No newline at end of file
+        waitress.serve(app, port=8001, _quiet=True, threads=24)
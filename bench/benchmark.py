@@ -0,0 +1,297 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+# Drives a running STB-Proxy (or one launched against fakeportal.py) and
+# reports latency percentiles, stream throughput and the proxy's CPU/memory.
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchDir, ".."))
+import stb  # for portal discovery, as the add portal form does it
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class ProcessSampler:
+    # samples CPU time and resident memory of a pid from /proc
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peakRss = 0
+        self.stopped = threading.Event()
+
+    def cpuSeconds(self):
+        with open("/proc/{}/stat".format(self.pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def rss(self):
+        with open("/proc/{}/status".format(self.pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def sample(self):
+        while not self.stopped.wait(0.2):
+            self.peakRss = max(self.peakRss, self.rss())
+
+    def __enter__(self):
+        self.startCpu = self.cpuSeconds()
+        self.startTime = time.time()
+        self.peakRss = self.rss()
+        threading.Thread(target=self.sample, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        elapsed = time.time() - self.startTime
+        self.cpu = (self.cpuSeconds() - self.startCpu) / elapsed * 100 if elapsed else 0
+
+
+def fetch(session, url):
+    start = time.time()
+    try:
+        response = session.get(url, timeout=60)
+        size = len(response.content)
+        ok = response.status_code == 200
+    except requests.RequestException:
+        size = 0
+        ok = False
+    return time.time() - start, size, ok
+
+
+def benchEndpoint(session, base, path, count, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(
+            executor.map(lambda i: fetch(session, base + path), range(count))
+        )
+    latencies = [r[0] * 1000 for r in results if r[2]]
+    return {
+        "name": path,
+        "ok": len(latencies),
+        "errors": count - len(latencies),
+        "bytes": max([r[1] for r in results] or [0]),
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies or [0]),
+    }
+
+
+def watch(session, url, seconds):
+    # returns (ms to first byte or None, bytes received)
+    start = time.time()
+    firstByte = None
+    received = 0
+    try:
+        with session.get(url, stream=True, timeout=30) as response:
+            if response.status_code != 200:
+                return None, 0
+            for chunk in response.iter_content(64 * 1024):
+                if firstByte is None:
+                    firstByte = (time.time() - start) * 1000
+                received = received + len(chunk)
+                if time.time() - start > seconds:
+                    break
+    except requests.RequestException:
+        pass
+    return firstByte, received
+
+
+def benchStreams(session, base, count, seconds, shared):
+    playlist = session.get(base + "/playlist", timeout=60).text
+    urls = [line for line in playlist.splitlines() if line.startswith("http")]
+    if not urls:
+        return None
+    if shared:
+        urls = [urls[0]] * count
+    else:
+        urls = (urls * count)[:count]
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        results = list(executor.map(lambda u: watch(session, u, seconds), urls))
+    elapsed = time.time() - start
+    tunes = [r[0] for r in results if r[0] is not None]
+    received = sum(r[1] for r in results)
+    return {
+        "name": "{} {} streams".format(count, "shared" if shared else "distinct"),
+        "ok": len(tunes),
+        "errors": count - len(tunes),
+        "bytes": received,
+        "p50": percentile(tunes, 50),
+        "p90": percentile(tunes, 90),
+        "p99": percentile(tunes, 99),
+        "max": max(tunes or [0]),
+        "rate": received / elapsed / 1024 / 1024,
+    }
+
+
+def wait(url):
+    for i in range(100):
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+
+
+def launch(args):
+    # starts fakeportal.py and app.py with a throwaway config, returns the processes
+    workDir = tempfile.mkdtemp(prefix="stb-bench-")
+    portal = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(benchDir, "fakeportal.py"),
+            "--port",
+            str(args.portal_port),
+            "--channels",
+            str(args.channels),
+            "--latency",
+            str(args.latency),
+            "--failure-rate",
+            str(args.failure_rate),
+        ],
+        cwd=workDir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    portalBase = "http://127.0.0.1:{}".format(args.portal_port)
+    wait(portalBase + "/stats")
+
+    # resolve the endpoint from xpcom.common.js like a portal added without .php
+    url = stb.getUrl(portalBase + "/stalker_portal/c/")
+    if url != portalBase + "/stalker_portal/server/load.php":
+        portal.terminate()
+        sys.exit("Portal discovery failed, got {}".format(url))
+
+    macs = {
+        "00:1A:79:BE:00:{:02X}".format(i): "January 1, 2099" for i in range(args.macs)
+    }
+    config = {
+        "portals": {
+            "bench": {
+                "enabled": "true",
+                "name": "Bench",
+                "url": url,
+                "macs": macs,
+                "streams per mac": str(args.streams_per_mac),
+                "proxy": "",
+                "enabled channels": [str(i) for i in range(args.channels)],
+            }
+        },
+        "settings": {"stream method": "relay", "stream test method": "http"},
+    }
+    with open(os.path.join(workDir, "config.json"), "w") as f:
+        json.dump(config, f, indent=4)
+
+    env = dict(os.environ, CONFIG=os.path.join(workDir, "config.json"))
+    proxy = subprocess.Popen(
+        [sys.executable, os.path.join(benchDir, "..", "app.py")],
+        cwd=workDir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    wait(args.url + "/streaming")
+    print("Discovered {}".format(url))
+    print("Launched fake portal and proxy in {}".format(workDir))
+    return portal, proxy
+
+
+def report(rows, sampler):
+    print(
+        "{:<28}{:>6}{:>7}{:>12}{:>9}{:>9}{:>9}{:>9}{:>9}".format(
+            "test", "ok", "err", "bytes", "p50 ms", "p90 ms", "p99 ms", "max ms", "MB/s"
+        )
+    )
+    for row in rows:
+        print(
+            "{:<28}{:>6}{:>7}{:>12}{:>9.1f}{:>9.1f}{:>9.1f}{:>9.1f}{:>9}".format(
+                row["name"],
+                row["ok"],
+                row["errors"],
+                row["bytes"],
+                row["p50"],
+                row["p90"],
+                row["p99"],
+                row["max"],
+                "{:.2f}".format(row["rate"]) if "rate" in row else "",
+            )
+        )
+    if sampler:
+        print(
+            "proxy cpu {:.0f}% peak rss {:.1f} MB".format(
+                sampler.cpu, sampler.peakRss / 1024 / 1024
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark STB-Proxy")
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--auth", help="username:password if security is enabled")
+    parser.add_argument("--pid", type=int, help="proxy pid to sample CPU/memory")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--streams", type=int, default=20)
+    parser.add_argument("--stream-seconds", type=float, default=10)
+    parser.add_argument(
+        "--launch",
+        action="store_true",
+        help="start fakeportal.py and app.py with a throwaway config",
+    )
+    parser.add_argument("--portal-port", type=int, default=9100)
+    parser.add_argument("--channels", type=int, default=1000)
+    parser.add_argument("--macs", type=int, default=10)
+    parser.add_argument("--streams-per-mac", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=50)
+    parser.add_argument("--failure-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    processes = launch(args) if args.launch else ()
+    pid = processes[1].pid if processes else args.pid
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(args.streams, 10) * 2)
+    session.mount("http://", adapter)
+    if args.auth:
+        session.auth = tuple(args.auth.split(":", 1))
+
+    try:
+        sampler = ProcessSampler(pid) if pid else None
+        rows = []
+        with sampler or nullcontext():
+            for path in ["/playlist", "/xmltv", "/lineup.json"]:
+                fetch(session, args.url + path)  # warm the caches
+                rows.append(
+                    benchEndpoint(
+                        session, args.url, path, args.requests, args.concurrency
+                    )
+                )
+            for shared in [False, True]:
+                row = benchStreams(
+                    session, args.url, args.streams, args.stream_seconds, shared
+                )
+                if row:
+                    rows.append(row)
+        report(rows, sampler)
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import argparse
+import random
+import threading
+import time
+import flask
+
+# Stand-in Stalker middleware for benchmarking STB-Proxy without a real portal.
+# Serves the endpoints stb.py uses plus a paced MPEG-TS test stream per channel.
+
+app = flask.Flask(__name__)
+options = None
+stats = {}  # action -> requests served
+statsLock = threading.Lock()
+
+# stb.getUrl strips every "+" from this script, so the path group uses "*"
+xpcom = """var pattern = /(https?):\\/\\/([^\\/]*)\\/([\\w\\/]*)\\/c\\/*/;
+this.portal_protocol = result[1];
+this.portal_ip = result[2];
+this.portal_path = result[3];
+this.ajax_loader = this.portal_protocol + '://' + this.portal_ip + '/' + this.portal_path + '/server/load.php';"""
+
+
+def crc32mpeg(data):
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc = crc ^ (byte << 24)
+        for i in range(8):
+            crc = (crc << 1) ^ 0x04C11DB7 if crc & 0x80000000 else crc << 1
+            crc = crc & 0xFFFFFFFF
+    return crc.to_bytes(4, "big")
+
+
+def psiPacket(pid, section):
+    section = section + crc32mpeg(section)
+    header = bytes([0x47, 0x40 | (pid >> 8), pid & 0xFF, 0x10])
+    return (header + b"\x00" + section).ljust(188, b"\xff")
+
+
+# programme 1 on PMT PID 0x1000 with a single private data stream on PID 0x100
+pat = psiPacket(0, bytes.fromhex("00b00d0001c100000001f000"))
+pmt = psiPacket(0x1000, bytes.fromhex("02b0120001c10000e100f00006e100f000"))
+
+
+def tsStream(channelId):
+    # PAT/PMT then data packets, paced to the configured bitrate
+    packetsPerSecond = options.bitrate * 1000 / 8 / 188
+    packetsPerChunk = 100
+    payload = ("channel {} ".format(channelId) * 20).encode()[:184]
+    counter = 0
+    start = time.time()
+    sent = 0
+    while True:
+        chunk = [pat, pmt]
+        for i in range(packetsPerChunk - 2):
+            header = bytes([0x47, 0x01, 0x00, 0x10 | counter])
+            chunk.append(header + payload)
+            counter = (counter + 1) % 16
+        yield b"".join(chunk)
+        sent = sent + packetsPerChunk
+        delay = start + sent / packetsPerSecond - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def delay():
+    latency = options.latency * random.uniform(1 - options.jitter, 1 + options.jitter)
+    time.sleep(max(latency, 0) / 1000)
+
+
+def failed():
+    return random.random() < options.failure_rate
+
+
+def channels():
+    return [
+        {
+            "id": str(i),
+            "name": "Channel {}".format(i),
+            "number": str(i + 1),
+            "tv_genre_id": str(i % options.genres),
+            "cmd": "ffrt http://localhost/ch/{}".format(i),
+            "logo": "",
+        }
+        for i in range(options.channels)
+    ]
+
+
+@app.route("/stalker_portal/c/xpcom.common.js")
+def xpcomCommon():
+    return xpcom
+
+
+@app.route("/stalker_portal/server/load.php")
+def load():
+    action = flask.request.args.get("action", "")
+    with statsLock:
+        stats[action] = stats.get(action, 0) + 1
+    delay()
+    if failed():
+        return {"js": None}
+
+    if action == "handshake":
+        return {"js": {"token": "BENCH" + flask.request.cookies.get("mac", "")}}
+    elif action == "get_profile":
+        return {"js": {"id": 1, "name": "bench"}}
+    elif action == "get_main_info":
+        return {"js": {"phone": "January 1, 2099, 12:00 am"}}
+    elif action == "get_all_channels":
+        return {"js": {"data": allChannels}}
+    elif action == "get_genres":
+        return {
+            "js": [
+                {"id": str(i), "title": "Genre {}".format(i)}
+                for i in range(options.genres)
+            ]
+        }
+    elif action == "create_link":
+        channelId = flask.request.args.get("cmd", "").rsplit("/", 1)[-1]
+        return {
+            "js": {
+                "cmd": "ffrt http://{}/stream/{}.ts".format(
+                    flask.request.host, channelId
+                )
+            }
+        }
+    elif action == "get_epg_info":
+        period = int(flask.request.args.get("period", 24))
+        now = int(time.time()) // 3600 * 3600
+        return {
+            "js": {
+                "data": {
+                    c["id"]: [
+                        {
+                            "start_timestamp": now + h * 3600,
+                            "stop_timestamp": now + (h + 1) * 3600,
+                            "name": "Programme {}".format(h),
+                            "descr": "Description",
+                        }
+                        for h in range(period)
+                    ]
+                    for c in allChannels
+                }
+            }
+        }
+    return {"js": None}
+
+
+@app.route("/stream/<channelId>.ts")
+def stream(channelId):
+    with statsLock:
+        stats["stream"] = stats.get("stream", 0) + 1
+    delay()
+    if failed():
+        return flask.make_response("Stream unavailable", 404)
+    return flask.Response(tsStream(channelId), mimetype="video/mp2t")
+
+
+@app.route("/stats")
+def requestStats():
+    with statsLock:
+        return dict(stats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Stalker portal")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--channels", type=int, default=1000)
+    parser.add_argument("--genres", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=50, help="ms per request")
+    parser.add_argument("--jitter", type=float, default=0.5, help="latency +/- ratio")
+    parser.add_argument(
+        "--failure-rate", type=float, default=0, help="share of requests that fail"
+    )
+    parser.add_argument("--bitrate", type=int, default=4000, help="stream kbit/s")
+    options = parser.parse_args()
+    allChannels = channels()
+    app.run(host="0.0.0.0", port=options.port, threaded=True)
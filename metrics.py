@@ -0,0 +1,115 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Minimal Prometheus text format registry, shared by app.py and stb.py
+
+buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+lock = threading.Lock()
+types = {}  # metric name -> counter, gauge or histogram
+values = {}  # metric name -> {labels: value, or [bucket counts, sum, count]}
+local = threading.local()  # trace of the tune running on this thread
+
+
+def labelKey(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    key = labelKey(labels)
+    with lock:
+        types.setdefault(name, "counter")
+        series = values.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+
+
+def setGauge(name, value, **labels):
+    with lock:
+        types.setdefault(name, "gauge")
+        values.setdefault(name, {})[labelKey(labels)] = value
+
+
+def clear(name):
+    with lock:
+        values.pop(name, None)
+
+
+def observe(name, value, **labels):
+    key = labelKey(labels)
+    with lock:
+        types.setdefault(name, "histogram")
+        series = values.setdefault(name, {})
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = [[0] * len(buckets), 0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[0][i] = histogram[0][i] + 1
+        histogram[1] = histogram[1] + value
+        histogram[2] = histogram[2] + 1
+
+
+@contextmanager
+def timer(name, step=None, **labels):
+    # step also adds the duration to the current thread's trace, if any
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        observe(name, elapsed, **labels)
+        trace = getattr(local, "trace", None)
+        if step and trace is not None:
+            trace.append([step, round(elapsed * 1000)])
+
+
+def startTrace():
+    local.trace = []
+    return local.trace
+
+
+def stopTrace():
+    local.trace = None
+
+
+def formatLabels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '{}="{}"'.format(
+                k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            )
+            for k, v in pairs
+        )
+        + "}"
+    )
+
+
+def render():
+    lines = []
+    with lock:
+        for name in sorted(values):
+            kind = types[name]
+            lines.append("# TYPE {} {}".format(name, kind))
+            for key, value in values[name].items():
+                if kind != "histogram":
+                    lines.append("{}{} {}".format(name, formatLabels(key), value))
+                    continue
+                counts, total, count = value
+                for bound, bucketCount in zip(buckets, counts):
+                    lines.append(
+                        "{}_bucket{} {}".format(
+                            name, formatLabels(key, [("le", str(bound))]), bucketCount
+                        )
+                    )
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        name, formatLabels(key, [("le", "+Inf")]), count
+                    )
+                )
+                lines.append("{}_sum{} {}".format(name, formatLabels(key), total))
+                lines.append("{}_count{} {}".format(name, formatLabels(key), count))
+    return "\n".join(lines) + "\n"
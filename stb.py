@@ -1,25 +1,151 @@
 import requests
+import metrics
+import asyncio
 from requests.adapters import HTTPAdapter, Retry
 from urllib.parse import urlparse
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import time
 
-s = requests.Session()
-retries = Retry(total=3, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])
-s.mount("http://", HTTPAdapter(max_retries=retries))
+try:
+    import aiohttp  # only needed by AsyncPortal
+except ImportError:
+    aiohttp = None
 
+retries = Retry(
+    total=3,
+    connect=2,
+    read=1,
+    backoff_factor=0.1,
+    status_forcelist=[500, 502, 503, 504],
+)
+poolSize = 10  # connections kept per portal
+connectTimeout = 5
+readTimeout = 30
+clients = {}  # (scheme://host, proxy) -> requests.Session with its own pool
+clientsLock = threading.Lock()
 
-def getUrl(url, proxy=None):
+
+def configure(pool, connect, read):
+    # called with the app's settings, pools are rebuilt if their size changes
+    global poolSize, connectTimeout, readTimeout
+    connectTimeout = connect
+    readTimeout = read
+    with clientsLock:
+        if pool != poolSize:
+            poolSize = pool
+            for client in clients.values():
+                client.close()  # drops its idle keep-alive sockets
+            clients.clear()
+
+
+def timeouts():
+    return (connectTimeout, readTimeout)
+
+
+def getClient(url, proxy=None):
+    parsed = urlparse(url)
+    key = (parsed.scheme + "://" + parsed.netloc, proxy or None)
+    with clientsLock:
+        client = clients.get(key)
+        if client is None:
+            client = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=2, pool_maxsize=poolSize, max_retries=retries
+            )
+            client.mount("http://", adapter)
+            client.mount("https://", adapter)
+            if proxy:
+                client.proxies = {"http": proxy, "https": proxy}
+            clients[key] = client
+        return client
+
+
+def poolStats():
+    # per (host, proxy): open connections, idle connections and requests sent
+    with clientsLock:
+        items = list(clients.items())
+    stats = []
+    for (host, proxy), client in items:
+        adapter = client.get_adapter("http://")
+        managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+        connections = idle = sent = 0
+        for manager in managers:
+            for key in list(manager.pools.keys()):
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                connections = connections + pool.num_connections
+                sent = sent + pool.num_requests
+                if pool.pool is not None:
+                    idle = idle + sum(1 for c in list(pool.pool.queue) if c)
+        stats.append(
+            {
+                "host": host,
+                "proxy": urlparse(proxy).netloc.rsplit("@", 1)[-1] if proxy else "",
+                "connections": connections,
+                "idle": idle,
+                "requests": sent,
+            }
+        )
+    return stats
+
+
+def stbCookies(mac):
+    return {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
+
+
+def stbHeaders(token=None):
+    headers = {"User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)"}
+    if token:
+        headers["Authorization"] = "Bearer " + token
+    return headers
+
+
+streams = requests.Session()
+streams.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=100))
+streams.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=100))
+
+
+def openStream(url, proxy=None, timeout=None):
+    proxies = {"http": proxy, "https": proxy}
+    headers = stbHeaders()
+    response = streams.get(
+        url, headers=headers, proxies=proxies, stream=True, timeout=timeout
+    )
+    response.raise_for_status()
+    return response
+
+
+javaStrip = str.maketrans("", "", " '+")
+patternRe = re.compile(r"varpattern.*\/(\(http.*)\/;")
+protocolRe = re.compile(r"this\.portal_protocol.*(\d).*;")
+ipRe = re.compile(r"this\.portal_ip.*(\d).*;")
+pathRe = re.compile(r"this\.portal_path.*(\d).*;")
+loaderRe = re.compile(r"this\.ajax_loader=(.*\.php);")
+xpcomPaths = [
+    "/c/xpcom.common.js",
+    "/client/xpcom.common.js",
+    "/c_/xpcom.common.js",
+    "/stalker_portal/c/xpcom.common.js",
+    "/stalker_portal/c_/xpcom.common.js",
+]
+resolvedUrls = {}  # scheme://host -> portal endpoint
+
+
+def getUrl(url, proxy=None, timeout=5, refresh=False):
     def parseResponse(url, data):
-        java = data.text.replace(" ", "").replace("'", "").replace("+", "")
-        pattern = re.search(r"varpattern.*\/(\(http.*)\/;", java).group(1)
+        java = data.text.translate(javaStrip)
+        pattern = patternRe.search(java).group(1)
         result = re.search(pattern, url)
-        protocolIndex = re.search(r"this\.portal_protocol.*(\d).*;", java).group(1)
-        ipIndex = re.search(r"this\.portal_ip.*(\d).*;", java).group(1)
-        pathIndex = re.search(r"this\.portal_path.*(\d).*;", java).group(1)
+        protocolIndex = protocolRe.search(java).group(1)
+        ipIndex = ipRe.search(java).group(1)
+        pathIndex = pathRe.search(java).group(1)
         protocol = result.group(int(protocolIndex))
         ip = result.group(int(ipIndex))
         path = result.group(int(pathIndex))
-        portalPatern = re.search(r"this\.ajax_loader=(.*\.php);", java).group(1)
+        portalPatern = loaderRe.search(java).group(1)
         portal = (
             portalPatern.replace("this.portal_protocol", protocol)
             .replace("this.portal_ip", ip)
@@ -27,203 +153,367 @@ def getUrl(url, proxy=None):
         )
         return portal
 
+    def probe(path, proxy):
+        client = getClient(url, proxy)
+        response = client.get(url + path, headers=headers, timeout=timeout)
+        if response:
+            return parseResponse(url + path, response)
+
     url = urlparse(url).scheme + "://" + urlparse(url).netloc
-    urls = [
-        "/c/xpcom.common.js",
-        "/client/xpcom.common.js",
-        "/c_/xpcom.common.js",
-        "/stalker_portal/c/xpcom.common.js",
-        "/stalker_portal/c_/xpcom.common.js",
-    ]
+    if url in resolvedUrls and not refresh:
+        return resolvedUrls[url]
 
-    proxies = {"http": proxy, "https": proxy}
-    headers = {"User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)"}
+    headers = stbHeaders()
+
+    # sometimes these pages dont like proxies! so try without one second
+    for candidate in [proxy, None]:
+        executor = ThreadPoolExecutor(max_workers=len(xpcomPaths))
+        futures = [executor.submit(probe, path, candidate) for path in xpcomPaths]
+        try:
+            # paths are probed at once but the first working one in list order
+            # wins, so the result does not depend on which answers first
+            for future in futures:
+                try:
+                    portal = future.result()
+                except:
+                    portal = None
+                if portal:
+                    resolvedUrls[url] = portal
+                    return portal
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Portal actions #
 
+# action -> (query, parse). The query is formatted with the call's extra
+# arguments and parse picks the result out of the response's "js" field.
+actions = {
+    "getToken": (
+        "?type=stb&action=handshake&JsHttpRequest=1-xml",
+        lambda js: js["token"],
+    ),
+    "getProfile": (
+        "?type=stb&action=get_profile&JsHttpRequest=1-xml",
+        lambda js: js,
+    ),
+    "getExpires": (
+        "?type=account_info&action=get_main_info&JsHttpRequest=1-xml",
+        lambda js: js["phone"],
+    ),
+    "getAllChannels": (
+        "?type=itv&action=get_all_channels&force_ch_link_check=&JsHttpRequest=1-xml",
+        lambda js: js["data"],
+    ),
+    "getGenres": (
+        "?action=get_genres&type=itv&JsHttpRequest=1-xml",
+        lambda js: js,
+    ),
+    "getLink": (
+        "?type=itv&action=create_link&cmd={}&series=0&forced_storage=false&disable_ad=false&download=false&force_ch_link_check=false&JsHttpRequest=1-xml",
+        lambda js: js["cmd"].split()[-1],
+    ),
+    "getEpg": (
+        "?type=itv&action=get_epg_info&period={}&JsHttpRequest=1-xml",
+        lambda js: js["data"],
+    ),
+}
+
+
+def portalGet(action, url, mac, token, *args, proxy=None):
+    # one portal request, None if it fails or returns nothing
+    query, parse = actions[action]
     try:
-        for i in urls:
-            try:
-                response = s.get(url + i, headers=headers, proxies=proxies)
-            except:
-                response = None
-            if response:
-                return parseResponse(url + i, response)
+        response = getClient(url, proxy).get(
+            url + query.format(*args),
+            cookies=stbCookies(mac),
+            headers=stbHeaders(token),
+            timeout=timeouts(),
+        )
+        result = parse(response.json()["js"])
+        if result:
+            return result
     except:
         pass
 
-    # sometimes these pages dont like proxies!
+
+def genreNames(genreData):
     try:
-        for i in urls:
-            try:
-                response = s.get(url + i, headers=headers)
-            except:
-                response = None
-            if response:
-                return parseResponse(url + i, response)
+        genres = {i["id"]: i["title"] for i in genreData}
+        if genres:
+            return genres
     except:
         pass
 
 
 def getToken(url, mac, proxy=None):
-    proxies = {"http": proxy, "https": proxy}
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
-    headers = {"User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)"}
-    try:
-        response = s.get(
-            url + "?type=stb&action=handshake&JsHttpRequest=1-xml",
-            cookies=cookies,
-            headers=headers,
-            proxies=proxies,
-        )
-        token = response.json()["js"]["token"]
-        if token:
-            return token
-    except:
-        pass
+    return portalGet("getToken", url, mac, None, proxy=proxy)
 
 
 def getProfile(url, mac, token, proxy=None):
-    proxies = {"http": proxy, "https": proxy}
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
-    headers = {
-        "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
-        "Authorization": "Bearer " + token,
-    }
-    try:
-        response = s.get(
-            url + "?type=stb&action=get_profile&JsHttpRequest=1-xml",
-            cookies=cookies,
-            headers=headers,
-            proxies=proxies,
-        )
-        profile = response.json()["js"]
-        if profile:
-            return profile
-    except:
-        pass
+    return portalGet("getProfile", url, mac, token, proxy=proxy)
 
 
 def getExpires(url, mac, token, proxy=None):
-    proxies = {"http": proxy, "https": proxy}
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
-    headers = {
-        "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
-        "Authorization": "Bearer " + token,
-    }
-    try:
-        response = s.get(
-            url + "?type=account_info&action=get_main_info&JsHttpRequest=1-xml",
-            cookies=cookies,
-            headers=headers,
-            proxies=proxies,
-        )
-        expires = response.json()["js"]["phone"]
-        if expires:
-            return expires
-    except:
-        pass
+    return portalGet("getExpires", url, mac, token, proxy=proxy)
 
 
 def getAllChannels(url, mac, token, proxy=None):
-    proxies = {"http": proxy, "https": proxy}
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
-    headers = {
-        "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
-        "Authorization": "Bearer " + token,
-    }
-    try:
-        response = s.get(
-            url
-            + "?type=itv&action=get_all_channels&force_ch_link_check=&JsHttpRequest=1-xml",
-            cookies=cookies,
-            headers=headers,
-            proxies=proxies,
-        )
-        channels = response.json()["js"]["data"]
-        if channels:
-            return channels
-    except:
-        pass
+    return portalGet("getAllChannels", url, mac, token, proxy=proxy)
 
 
 def getGenres(url, mac, token, proxy=None):
-    proxies = {"http": proxy, "https": proxy}
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
-    headers = {
-        "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
-        "Authorization": "Bearer " + token,
-    }
-    try:
-        response = s.get(
-            url + "?action=get_genres&type=itv&JsHttpRequest=1-xml",
-            cookies=cookies,
-            headers=headers,
-            proxies=proxies,
-        )
-        genreData = response.json()["js"]
-        if genreData:
-            return genreData
-    except:
-        pass
+    return portalGet("getGenres", url, mac, token, proxy=proxy)
 
 
 def getGenreNames(url, mac, token, proxy=None):
-    try:
-        genreData = getGenres(url, mac, token, proxy)
-        genres = {}
-        for i in genreData:
-            gid = i["id"]
-            name = i["title"]
-            genres[gid] = name
-        if genres:
-            return genres
-    except:
-        pass
+    return genreNames(getGenres(url, mac, token, proxy))
 
 
 def getLink(url, mac, token, cmd, proxy=None):
-    proxies = {"http": proxy, "https": proxy}
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
-    headers = {
-        "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
-        "Authorization": "Bearer " + token,
-    }
-    try:
-        response = s.get(
-            url
-            + "?type=itv&action=create_link&cmd="
-            + cmd
-            + "&series=0&forced_storage=false&disable_ad=false&download=false&force_ch_link_check=false&JsHttpRequest=1-xml",
-            cookies=cookies,
-            headers=headers,
-            proxies=proxies,
-        )
-        data = response.json()
-        link = data["js"]["cmd"].split()[-1]
-        if link:
-            return link
-    except:
-        pass
+    return portalGet("getLink", url, mac, token, cmd, proxy=proxy)
 
 
 def getEpg(url, mac, token, period, proxy=None):
-    proxies = {"http": proxy, "https": proxy}
-    cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
-    headers = {
-        "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
-        "Authorization": "Bearer " + token,
-    }
+    return portalGet("getEpg", url, mac, token, period, proxy=proxy)
+
+
+# Single flight #
+
+flights = {}  # call key -> Flight of the call in progress
+flightsLock = threading.Lock()
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def singleFlight(key, func, *args, **kwargs):
+    # key is (url, mac, action, *params); the first caller runs func and callers
+    # arriving meanwhile wait for its result
+    with flightsLock:
+        flight = flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = flights[key] = Flight()
+
+    if not leader:
+        metrics.inc("stb_coalesced_calls_total", action=key[2])
+        flight.done.wait()
+        if flight.error:
+            raise flight.error
+        return flight.result
+
     try:
-        response = s.get(
-            url
-            + "?type=itv&action=get_epg_info&period="
-            + str(period)
-            + "&JsHttpRequest=1-xml",
-            cookies=cookies,
-            headers=headers,
-            proxies=proxies,
+        flight.result = func(*args, **kwargs)
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with flightsLock:
+            del flights[key]
+        flight.done.set()
+
+
+# Sessions #
+
+sessionLifetime = 3600
+sessions = {}
+sessionLocks = {}
+sessionsLock = threading.Lock()
+
+
+def getSessionLock(url, mac):
+    with sessionsLock:
+        return sessionLocks.setdefault((url, mac), threading.Lock())
+
+
+def getSession(url, mac, proxy=None, force=False):
+    key = (url, mac)
+    with getSessionLock(url, mac):
+        session = sessions.get(key)
+        if session and not force and time.time() < session["expires"]:
+            return session["token"]
+
+        sessions.pop(key, None)
+        with metrics.timer(
+            "stb_portal_request_seconds",
+            step="handshake",
+            host=urlparse(url).netloc,
+            action="handshake",
+        ):
+            token = getToken(url, mac, proxy)
+            profile = getProfile(url, mac, token, proxy) if token else None
+        if token:
+            sessions[key] = {
+                "token": token,
+                "profile": profile,
+                "expires": time.time() + sessionLifetime,
+            }
+            return token
+
+
+def invalidateSession(url, mac):
+    with getSessionLock(url, mac):
+        sessions.pop((url, mac), None)
+
+
+def sessionCall(func, url, mac, *args, proxy=None):
+    # identical concurrent calls share one upstream request and its result
+    return singleFlight(
+        (url, mac, func.__name__) + args,
+        callWithSession,
+        func,
+        url,
+        mac,
+        *args,
+        proxy=proxy,
+    )
+
+
+def callWithSession(func, url, mac, *args, proxy=None):
+    # Runs func with a pooled token, re-handshaking once if the call fails
+    cached = sessions.get((url, mac))
+    token = getSession(url, mac, proxy)
+    if token:
+        with metrics.timer(
+            "stb_portal_request_seconds",
+            step=func.__name__,
+            host=urlparse(url).netloc,
+            action=func.__name__,
+        ):
+            result = func(url, mac, token, *args, proxy=proxy)
+        if result or not cached or cached["token"] != token:
+            return result  # token was fresh, a retry would not help
+    token = getSession(url, mac, proxy, force=True)
+    if token:
+        with metrics.timer(
+            "stb_portal_request_seconds",
+            step=func.__name__,
+            host=urlparse(url).netloc,
+            action=func.__name__,
+        ):
+            return func(url, mac, token, *args, proxy=proxy)
+
+
+# Async client #
+
+
+def asyncSession(limit=100):
+    # one connection pool shared by many AsyncPortals, create it inside the loop
+    if aiohttp is None:
+        raise RuntimeError("aiohttp is needed for the async client")
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=limit, limit_per_host=poolSize),
+        timeout=aiohttp.ClientTimeout(
+            sock_connect=connectTimeout, sock_read=readTimeout
+        ),
+    )
+
+
+class AsyncPortal:
+    # Coroutine version of the functions above for one portal and MAC. Handles
+    # its own token like callWithSession and returns None on failure.
+    #
+    #   async with asyncSession() as session:
+    #       portals = [AsyncPortal(url, mac, proxy, session) for mac in macs]
+    #       expiries = await asyncio.gather(*[p.getExpires() for p in portals])
+
+    def __init__(self, url, mac, proxy=None, session=None):
+        self.url = url
+        self.mac = mac
+        self.proxy = proxy or None
+        self.session = session
+        self.ownSession = session is None
+        self.token = None
+        self.profile = None
+        self.expires = 0
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        if self.ownSession and self.session:
+            await self.session.close()
+            self.session = None
+
+    async def request(self, action, token, *args):
+        if self.session is None:
+            self.session = asyncSession()
+        query, parse = actions[action]
+        async with self.session.get(
+            self.url + query.format(*args),
+            cookies=stbCookies(self.mac),
+            headers=stbHeaders(token),
+            proxy=self.proxy,
+        ) as response:
+            return parse((await response.json(content_type=None))["js"])
+
+    def timer(self, action):
+        return metrics.timer(
+            "stb_portal_request_seconds",
+            host=urlparse(self.url).netloc,
+            action=action,
         )
-        data = response.json()["js"]["data"]
-        if data:
-            return data
-    except:
-        pass
+
+    async def getToken(self, force=False):
+        async with self.lock:
+            if self.token and not force and time.time() < self.expires:
+                return self.token
+            self.token = None
+            try:
+                with self.timer("handshake"):
+                    token = await self.request("getToken", None)
+                    if not token:
+                        return None
+                    self.profile = await self.request("getProfile", token)
+            except Exception:
+                return None
+            self.token = token
+            self.expires = time.time() + sessionLifetime
+            return token
+
+    async def call(self, action, *args):
+        # re-handshakes once if a call with a cached token fails
+        cached = self.token if time.time() < self.expires else None
+        for force in [False, True]:
+            token = await self.getToken(force)
+            if not token:
+                return None
+            try:
+                with self.timer(action):
+                    result = await self.request(action, token, *args)
+            except Exception:
+                result = None
+            if result or cached != token:
+                return result
+
+    async def getProfile(self):
+        if await self.getToken():
+            return self.profile
+
+    async def getExpires(self):
+        return await self.call("getExpires")
+
+    async def getAllChannels(self):
+        return await self.call("getAllChannels")
+
+    async def getGenres(self):
+        return await self.call("getGenres")
+
+    async def getGenreNames(self):
+        return genreNames(await self.getGenres())
+
+    async def getLink(self, cmd):
+        return await self.call("getLink", cmd)
+
+    async def getEpg(self, period):
+        return await self.call("getEpg", period)